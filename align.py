@@ -0,0 +1,120 @@
+"""
+Video Quality Metrics
+Copyright (c) 2014 Alex Izvorski <aizvorski@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Temporal alignment of a distorted video to its reference
+
+When an encoder drops or duplicates frames, frame N of the distorted video is no longer frame N of the
+reference.  Before the expensive metrics run, each distorted frame is matched to a reference frame by PSNR
+on heavily downsampled luma thumbnails (1/8 x 1/8 by default, 1/64 of the pixels).  Thumbnails are computed
+once per frame and cached, so the whole search costs a small fraction of one full VIFP pass.
+
+The result is an alignment map: a list of (ref frame, dist frame) pairs that video.score_video() can score
+directly.
+"""
+
+import numpy
+
+import psnr
+
+"""
+Luma thumbnail: mean of each factor x factor block
+"""
+def thumbnail(y, factor=8):
+    h = y.shape[0] // factor
+    w = y.shape[1] // factor
+    blocks = y[:h*factor, :w*factor].reshape(h, factor, w, factor)
+    return blocks.mean(axis=(1, 3), dtype=numpy.float32)
+
+"""
+Thumbnails of all frames of a YuvReader, computed on first use
+"""
+class Thumbnails(object):
+    def __init__(self, reader, factor=8):
+        self.reader = reader
+        self.factor = factor
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.reader)
+
+    def __getitem__(self, n):
+        thumb = self.cache.get(n)
+        if thumb is None:
+            y, _, _ = self.reader.frame(n)
+            thumb = self.cache[n] = thumbnail(y, self.factor)
+        return thumb
+
+"""
+Global temporal offset: dist frame i shows ref frame i + offset.
+Tries every offset in [-max_offset, max_offset] on up to num_frames frames from the start of the videos.
+"""
+def find_offset(ref_thumbs, dist_thumbs, max_offset=8, num_frames=30):
+    best_offset, best_psnr = 0, -numpy.inf
+    for offset in range(-max_offset, max_offset + 1):
+        dist_frames = [i for i in range(min(num_frames, len(dist_thumbs))) if 0 <= i + offset < len(ref_thumbs)]
+        if not dist_frames:
+            continue
+        value = numpy.mean([psnr.psnr(ref_thumbs[i + offset], dist_thumbs[i]) for i in dist_frames])
+        if value > best_psnr:
+            best_offset, best_psnr = offset, value
+    return best_offset
+
+class Alignment(object):
+    def __init__(self, pairs, offset, unmatched=()):
+        self.pairs = pairs
+        self.offset = offset
+        # Distorted frames before the start or after the end of the reference, which are not scored
+        self.unmatched = list(unmatched)
+        # Reference frames skipped by the distorted video, and distorted frames repeating the previous ref frame
+        self.dropped = []
+        self.duplicated = []
+        for (prev_ref, _), (ref, dist) in zip(pairs, pairs[1:]):
+            if ref == prev_ref:
+                self.duplicated.append(dist)
+            elif ref > prev_ref + 1:
+                self.dropped.extend(range(prev_ref + 1, ref))
+
+"""
+Match every distorted frame to a reference frame.
+Each distorted frame is searched for within +-window frames of where the previous match predicts it
+(the next reference frame), so the alignment follows drops and duplicates as they accumulate.
+Ties go to the predicted frame.  Distorted frames predicted before the first or after the last reference
+frame (e.g. leading frames when the offset is negative) have no counterpart and are left unmatched.
+"""
+def align(ref_thumbs, dist_thumbs, window=8, max_offset=None):
+    if max_offset is None:
+        max_offset = window
+    offset = find_offset(ref_thumbs, dist_thumbs, max_offset)
+
+    pairs = []
+    unmatched = []
+    expected = offset
+    for dist in range(len(dist_thumbs)):
+        if not 0 <= expected < len(ref_thumbs):
+            unmatched.append(dist)
+            expected += 1
+            continue
+        candidates = [j for j in range(expected - window, expected + window + 1) if 0 <= j < len(ref_thumbs)]
+        # Predicted frame first, then outwards, so that ties prefer the smallest jump
+        candidates.sort(key=lambda j: abs(j - expected))
+        values = [psnr.psnr(ref_thumbs[j], dist_thumbs[dist]) for j in candidates]
+        ref = candidates[int(numpy.argmax(values))]
+        pairs.append((ref, dist))
+        expected = ref + 1
+    return Alignment(pairs, offset, unmatched)
@@ -0,0 +1,242 @@
+from __future__ import print_function
+
+"""
+Video Quality Metrics
+Copyright (c) 2014 Alex Izvorski <aizvorski@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Benchmark of the metrics on synthetic frames
+
+Reference frames are generated from a fixed seed (smooth multi-scale texture with hard edges, so that
+every metric has structure to work on), and each is distorted by additive noise, Gaussian blur or 8x8
+blocking.  The same frames are produced on every machine and every run.
+
+Every metric is timed on its own, on the luma plane as measure.py passes it, and so is the per-frame
+video pipeline (video.score_frame on 8-bit planes).  Each measurement is repeated after warm-up runs;
+the JSON output holds every timing along with the software versions and commit, so runs can be compared
+with --compare.
+
+Usage:
+    python benchmark.py [--resolutions 480p,1080p,2160p] [--repeat 5] [--output bench.json]
+    python benchmark.py --compare old.json --output new.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy
+import scipy
+import scipy.ndimage
+
+import filters
+import vifp
+import ssim
+import psnr
+import niqe
+import reco
+import video
+
+RESOLUTIONS = {
+    '480p': (854, 480),
+    '1080p': (1920, 1080),
+    '2160p': (3840, 2160),
+}
+
+DISTORTIONS = ('noise', 'blur', 'blocking')
+
+"""
+Metric functions on float luma planes in 0-255, called the way measure.py calls them
+"""
+METRICS = {
+    'psnr': lambda ref, dist: psnr.psnr(ref, dist),
+    'ssim': lambda ref, dist: ssim.ssim(ref/255, dist/255),
+    'ssim_exact': lambda ref, dist: ssim.ssim_exact(ref/255, dist/255),
+    'vifp': lambda ref, dist: vifp.vifp_mscale(ref, dist),
+    'reco': lambda ref, dist: reco.reco(ref/255, dist/255),
+    'niqe': lambda ref, dist: niqe.niqe(dist/255),
+}
+
+PIPELINE_METRICS = ('vifp', 'ssim', 'psnr')
+
+"""
+Deterministic 8-bit reference frame
+"""
+def synthetic_reference(width, height, seed=0):
+    rs = numpy.random.RandomState(seed)
+    img = numpy.zeros((height, width))
+    # Texture at several scales
+    for sd, amplitude in ((32.0, 60.0), (8.0, 30.0), (2.0, 15.0), (0.7, 6.0)):
+        layer = scipy.ndimage.gaussian_filter(rs.standard_normal((height, width)), sd, mode='wrap')
+        img += amplitude * layer / (layer.std() + 1e-12)
+    # Gradient and hard-edged rectangles
+    img += numpy.linspace(-40, 40, width)[numpy.newaxis, :]
+    for _ in range(24):
+        y0, x0 = rs.randint(0, height), rs.randint(0, width)
+        y1, x1 = y0 + rs.randint(height // 16, height // 3), x0 + rs.randint(width // 16, width // 3)
+        img[y0:y1, x0:x1] += rs.uniform(-50, 50)
+    return numpy.clip(numpy.round(img + 128), 0, 255).astype(numpy.uint8)
+
+"""
+Deterministic distorted version of an 8-bit frame
+"""
+def distort(ref, kind, seed=0):
+    img = ref.astype(numpy.float64)
+    if kind == 'noise':
+        img += numpy.random.RandomState(seed + 1).normal(0, 8.0, img.shape)
+    elif kind == 'blur':
+        img = scipy.ndimage.gaussian_filter(img, 1.5)
+    elif kind == 'blocking':
+        # Keep each 8x8 block's mean and half of its detail, as a coarse quantizer would
+        h, w = (img.shape[0] // 8) * 8, (img.shape[1] // 8) * 8
+        blocks = img[:h, :w].reshape(h // 8, 8, w // 8, 8)
+        means = blocks.mean(axis=(1, 3), keepdims=True)
+        img[:h, :w] = (means + 0.5 * (blocks - means)).reshape(h, w)
+    else:
+        raise ValueError("Unknown distortion %s, expected one of %s" % (kind, ", ".join(DISTORTIONS)))
+    return numpy.clip(numpy.round(img), 0, 255).astype(numpy.uint8)
+
+def frame_pair(width, height, distortion, seed=0):
+    ref = synthetic_reference(width, height, seed)
+    return ref, distort(ref, distortion, seed)
+
+"""
+Run func() warmup times untimed, then repeat times; returns the times in seconds
+"""
+def time_function(func, repeat=5, warmup=1):
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+def timing_stats(times, width, height):
+    times = numpy.asarray(times)
+    median = float(numpy.median(times))
+    return {
+        'times': [float(t) for t in times],
+        'mean': float(numpy.mean(times)),
+        'std': float(numpy.std(times, ddof=1)) if len(times) > 1 else 0.0,
+        'min': float(numpy.min(times)),
+        'median': median,
+        'fps': 1.0 / median,
+        # 8-bit luma of the reference and the distorted frame
+        'mb_per_s': 2 * width * height / median / 1e6,
+    }
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment():
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'scipy': scipy.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'filter_backend': list(filters.get_backend()),
+    }
+
+"""
+Time every metric and the pipeline on every (resolution, distortion) pair
+Returns the list of result dicts; progress lines go to log if given.
+"""
+def run(resolutions=('480p', '1080p', '2160p'), distortions=DISTORTIONS, metrics=tuple(sorted(METRICS)),
+        pipeline=True, repeat=5, warmup=1, seed=0, log=None):
+    results = []
+    for resolution in resolutions:
+        width, height = RESOLUTIONS[resolution]
+        for distortion in distortions:
+            ref8, dist8 = frame_pair(width, height, distortion, seed)
+            ref, dist = ref8.astype(numpy.float64), dist8.astype(numpy.float64)
+
+            cases = [(name, lambda name=name: METRICS[name](ref, dist)) for name in metrics]
+            if pipeline:
+                cases.append(('pipeline', lambda: video.score_frame(ref8, dist8, PIPELINE_METRICS)))
+
+            for name, func in cases:
+                result = {'resolution': resolution, 'width': width, 'height': height, 'distortion': distortion, 'metric': name}
+                result.update(timing_stats(time_function(func, repeat, warmup), width, height))
+                results.append(result)
+                if log is not None:
+                    print("%-6s %-9s %-10s %9.2f ms  %8.2f fps  %8.1f MB/s  (+-%.2f ms)" % (
+                        resolution, distortion, name, result['median'] * 1e3, result['fps'], result['mb_per_s'], result['std'] * 1e3), file=log)
+    return results
+
+def _key(result):
+    return (result['resolution'], result['distortion'], result['metric'])
+
+"""
+Ratio of median times of matching results, old / new (above 1 means new is faster)
+"""
+def compare(old_results, new_results):
+    old = dict((_key(r), r) for r in old_results)
+    return [(_key(r), old[_key(r)]['median'] / r['median']) for r in new_results if _key(r) in old]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the metrics on deterministic synthetic frames")
+    parser.add_argument("--resolutions", default="480p,1080p,2160p", help="comma-separated, from %s (default: %%(default)s)" % (", ".join(sorted(RESOLUTIONS))))
+    parser.add_argument("--distortions", default=",".join(DISTORTIONS), help="comma-separated (default: %(default)s)")
+    parser.add_argument("--metrics", default=",".join(sorted(METRICS)), help="comma-separated (default: %(default)s)")
+    parser.add_argument("--no-pipeline", action="store_true", help="don't time the per-frame video pipeline")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per measurement (default: %(default)s)")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed runs before them (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic frames (default: %(default)s)")
+    parser.add_argument("--filter-threads", type=int, default=1,
+                        help="threads used by the filters within one frame, 0 for one per CPU (default: %(default)s)")
+    parser.add_argument("--output", metavar="FILE", help="save the results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="print the speedup relative to the results in FILE")
+    args = parser.parse_args()
+
+    resolutions = args.resolutions.split(",")
+    distortions = args.distortions.split(",")
+    metrics = args.metrics.split(",")
+    for values, choices in ((resolutions, RESOLUTIONS), (distortions, DISTORTIONS), (metrics, METRICS)):
+        for value in values:
+            if value not in choices:
+                parser.error("unknown value %s, expected one of %s" % (value, ", ".join(sorted(choices))))
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    if args.filter_threads != 1:
+        filters.set_backend('threaded', args.filter_threads or None)
+
+    env = environment()
+    results = run(resolutions, distortions, metrics, not args.no_pipeline, args.repeat, args.warmup, args.seed, log=sys.stdout)
+
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump({'environment': env, 'repeat': args.repeat, 'warmup': args.warmup, 'seed': args.seed,
+                       'results': results}, fh, indent=2)
+        print("Saved results to %s" % (args.output))
+
+    if args.compare:
+        with open(args.compare) as fh:
+            old = json.load(fh)
+        print("Speedup relative to %s (commit %s):" % (args.compare, old['environment'].get('commit')))
+        for (resolution, distortion, name), ratio in compare(old['results'], results):
+            print("%-6s %-9s %-10s %6.2fx" % (resolution, distortion, name, ratio))
@@ -0,0 +1,222 @@
+"""
+Video Quality Metrics
+Copyright (c) 2014 Alex Izvorski <aizvorski@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Filtering backend shared by all metrics
+
+gaussian_filter() and convolve() have the same signature and results as their scipy.ndimage counterparts.
+With the 'scipy' backend (the default) they simply call scipy.ndimage.  With the 'threaded' backend the work
+of one call is split across a thread pool, so a single frame is filtered on all cores without the memory cost
+of extra processes:
+
+- gaussian_filter runs one 1-D pass per axis, like scipy does, and each pass is split into bands along
+  another axis; the lines filtered by different threads are independent, so the result is bitwise identical.
+- convolve splits the image into bands of rows, each with a halo of half the kernel height (or the image
+  border), and keeps the band interiors.
+- fft_workers() is the thread count to pass as scipy.fft's workers argument.
+
+scipy.ndimage releases the GIL while it filters, so the threads run in parallel.
+
+Whatever the backend, gaussian_filter blurs stacks of at least MATMUL_MIN_IMAGES float images along their
+last two axes (the batched metrics) as products with blocks of the banded filter matrix, which BLAS runs
+much faster than scipy.ndimage's per-line loop; the values differ from scipy's only by rounding (about 1e-15
+relative).  Smaller calls, including every single-image metric, use scipy.ndimage as above.
+
+Usage:
+    filters.set_backend('threaded')       # one thread per CPU
+    filters.set_backend('threaded', 4)
+    filters.set_backend('scipy')
+"""
+
+import concurrent.futures
+import functools
+import os
+import threading
+import numpy
+import scipy.ndimage
+
+BACKENDS = ('scipy', 'threaded')
+
+_backend = 'scipy'
+_threads = 1
+_pool = None
+# Held while the pool is created or replaced, so that threads filtering at once share a single pool
+_pool_lock = threading.Lock()
+
+# Arrays smaller than this many elements per thread are not worth splitting
+MIN_BAND_SIZE = 64 * 1024
+
+# Stacks of at least this many images are filtered with matrix products, and this many images at a time
+MATMUL_MIN_IMAGES = 8
+
+# Rows (or columns) of the output computed by each block of the filter matrix
+MATMUL_BLOCK = 32
+
+"""
+Select the backend.  threads=None uses one thread per CPU.
+"""
+def set_backend(name, threads=None):
+    global _backend, _threads, _pool
+    if name not in BACKENDS:
+        raise ValueError("Unknown filter backend %s, expected one of %s" % (name, ", ".join(BACKENDS)))
+    if threads is None:
+        threads = os.cpu_count() or 1
+    with _pool_lock:
+        if _pool is not None and (name != 'threaded' or threads != _threads):
+            _pool.shutdown()
+            _pool = None
+        _backend = name
+        _threads = threads if name == 'threaded' else 1
+
+def get_backend():
+    return _backend, _threads
+
+"""
+Thread count for scipy.fft's workers argument
+"""
+def fft_workers():
+    return _threads
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(_threads)
+        return _pool
+
+"""
+Start indices of the bands an axis of length n is split into for an array of size elements
+"""
+def _bands(n, size):
+    num_bands = min(_threads, n, max(1, size // MIN_BAND_SIZE))
+    return [n * i // num_bands for i in range(num_bands + 1)]
+
+def _run(tasks):
+    if len(tasks) == 1:
+        return [tasks[0]()]
+    return [future.result() for future in [_get_pool().submit(task) for task in tasks]]
+
+def gaussian_filter(input, sigma, output=None, mode='reflect', truncate=4.0):
+    if _use_matmul(input, sigma, output, mode):
+        return _gaussian_filter_matmul(input, sigma, output, mode, truncate)
+    if _backend == 'scipy':
+        return scipy.ndimage.gaussian_filter(input, sigma, output=output, mode=mode, truncate=truncate)
+
+    input = numpy.asarray(input)
+    if output is None:
+        output = numpy.empty(input.shape, dtype=input.dtype)
+    sigmas = numpy.broadcast_to(numpy.asarray(sigma, dtype=numpy.float64), (input.ndim,))
+    axes = [(axis, s) for axis, s in enumerate(sigmas) if s > 1e-15]
+    if not axes:
+        output[...] = input
+        return output
+
+    src = input
+    for axis, s in axes:
+        # Band along the longest other axis
+        others = [a for a in range(input.ndim) if a != axis]
+        split = max(others, key=lambda a: input.shape[a]) if others else None
+        if split is None:
+            scipy.ndimage.gaussian_filter1d(src, s, axis, output=output, mode=mode, truncate=truncate)
+        else:
+            starts = _bands(input.shape[split], input.size)
+
+            def task(begin, end, src=src, axis=axis, s=s, split=split):
+                band = (slice(None),) * split + (slice(begin, end),)
+                return lambda: scipy.ndimage.gaussian_filter1d(src[band], s, axis, output=output[band], mode=mode, truncate=truncate)
+
+            _run([task(begin, end) for begin, end in zip(starts, starts[1:])])
+        src = output
+    return output
+
+"""
+True for a stack of float images blurred along its last two axes only, with enough images to be worth
+filtering by matrix products
+"""
+def _use_matmul(input, sigma, output, mode):
+    if not isinstance(input, numpy.ndarray) or input.ndim < 3 or input.dtype.kind != 'f' or not isinstance(mode, str):
+        return False
+    if output is not None and (output.shape != input.shape or output.dtype != input.dtype or not output.flags.c_contiguous):
+        return False
+    sigmas = numpy.broadcast_to(numpy.asarray(sigma, dtype=numpy.float64), (input.ndim,))
+    if numpy.any(sigmas[:-2] != 0) or numpy.any(sigmas[-2:] <= 1e-15):
+        return False
+    return input.size // (input.shape[-2] * input.shape[-1]) >= MATMUL_MIN_IMAGES
+
+"""
+Blocks (begin, end, lo, hi, weights) of the n x n matrix of gaussian_filter1d along an axis of length n, so
+that output[begin:end] = weights.dot(input[lo:hi])
+"""
+@functools.lru_cache(maxsize=16)
+def _gaussian_blocks(n, sigma, mode, truncate, dtype):
+    # Column j is the response to an impulse at j, boundary handling included
+    matrix = scipy.ndimage.gaussian_filter1d(numpy.eye(n), sigma, axis=0, mode=mode, truncate=truncate)
+    blocks = []
+    for begin in range(0, n, MATMUL_BLOCK):
+        end = min(n, begin + MATMUL_BLOCK)
+        columns = numpy.flatnonzero(numpy.any(matrix[begin:end] != 0, axis=0))
+        lo, hi = columns[0], columns[-1] + 1
+        blocks.append((begin, end, lo, hi, numpy.array(matrix[begin:end, lo:hi], dtype=dtype)))
+    return blocks
+
+def _gaussian_filter_matmul(input, sigma, output, mode, truncate):
+    if output is None:
+        output = numpy.empty(input.shape, dtype=input.dtype)
+    sigmas = numpy.broadcast_to(numpy.asarray(sigma, dtype=numpy.float64), (input.ndim,))
+    h, w = input.shape[-2:]
+    rows = _gaussian_blocks(h, float(sigmas[-2]), mode, truncate, input.dtype)
+    cols = _gaussian_blocks(w, float(sigmas[-1]), mode, truncate, input.dtype)
+    images = input.reshape(-1, h, w)
+    out = output.reshape(-1, h, w)
+    tmp = numpy.empty((MATMUL_MIN_IMAGES, h, w), dtype=input.dtype)
+    # A few images at a time, so that the intermediate stays in cache; output may be input
+    for start in range(0, len(images), MATMUL_MIN_IMAGES):
+        group = images[start:start + MATMUL_MIN_IMAGES]
+        n = len(group)
+        for begin, end, lo, hi, weights in rows:
+            numpy.matmul(weights, group[:, lo:hi, :], out=tmp[:n, begin:end, :])
+        lines = tmp[:n].reshape(-1, w)
+        out_lines = out[start:start + n].reshape(-1, w)
+        for begin, end, lo, hi, weights in cols:
+            numpy.matmul(lines[:, lo:hi], weights.T, out=out_lines[:, begin:end])
+    return output
+
+def convolve(input, weights, output=None, mode='reflect'):
+    if _backend == 'scipy':
+        return scipy.ndimage.convolve(input, weights, output=output, mode=mode)
+
+    input = numpy.asarray(input)
+    if output is None:
+        output = numpy.empty(input.shape, dtype=input.dtype)
+    axis = input.ndim - 2 if input.ndim >= 2 else 0
+    n = input.shape[axis]
+    halo = weights.shape[axis] // 2 + 1
+    starts = _bands(n, input.size)
+
+    def task(begin, end):
+        lo, hi = max(0, begin - halo), min(n, end + halo)
+        region = (slice(None),) * axis + (slice(lo, hi),)
+        interior = (slice(None),) * axis + (slice(begin - lo, end - lo),)
+        band = (slice(None),) * axis + (slice(begin, end),)
+
+        def run():
+            output[band] = scipy.ndimage.convolve(input[region], weights, mode=mode)[interior]
+        return run
+
+    _run([task(begin, end) for begin, end in zip(starts, starts[1:])])
+    return output
@@ -0,0 +1,230 @@
+"""
+Video Quality Metrics
+Copyright (c) 2014 Alex Izvorski <aizvorski@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Timing and memory instrumentation of the scoring stages
+
+The code being measured marks its stages:
+    with instrument.stage('vifp.scale', scale=scale):
+        ...
+When no profiler is enabled, stage() returns a shared no-op context manager, so the cost is one function
+call per stage.  With a profiler enabled, every stage records its wall time and, optionally, the peak
+number of bytes allocated while it ran (through tracemalloc, which also sees numpy's arrays), and the frame
+it belongs to (the innermost enclosing frame() stage).
+
+Usage:
+    profiler = instrument.enable(memory=True)
+    profiler.add_hook(lambda record: ...)      # called with every finished Record
+    ...score...
+    instrument.disable()
+    print(profiler.summary())
+    profiler.write_chrome_trace('trace.json')  # for chrome://tracing or Perfetto
+
+Only stages run in this process are recorded (not those of video.score_video's worker processes).
+"""
+
+import collections
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+class Record(object):
+    __slots__ = ('name', 'args', 'frame', 'start', 'duration', 'peak_bytes', 'thread', 'depth')
+
+    def __init__(self, name, args, frame, start, thread, depth):
+        self.name = name
+        self.args = args
+        self.frame = frame
+        self.start = start
+        self.duration = None
+        self.peak_bytes = None
+        self.thread = thread
+        self.depth = depth
+
+class _NullStage(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+_null_stage = _NullStage()
+
+class _Stage(object):
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.record = self.profiler._begin(self.name, self.args)
+        return self.record
+
+    def __exit__(self, *exc_info):
+        self.profiler._end(self.record)
+        return False
+
+class Profiler(object):
+    """
+    memory: also record peak allocated bytes per stage (slower, tracemalloc traces every allocation)
+    keep_records: keep every Record for summary() and the trace; turn off when only hooks are needed
+    """
+    def __init__(self, memory=False, keep_records=True):
+        self.memory = memory
+        self.keep_records = keep_records
+        self.records = []
+        self.hooks = []
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+        self.started_tracemalloc = False
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def start(self):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+
+    def stop(self):
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    def stage(self, name, args):
+        return _Stage(self, name, args)
+
+    def _stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def _begin(self, name, args):
+        stack = self._stack()
+        if name == 'frame':
+            frame = args.get('frame')
+        else:
+            frame = stack[-1][0].frame if stack else None
+        record = Record(name, args, frame, 0.0, threading.current_thread().ident, len(stack))
+        # Per stage: [record, traced bytes at start, highest peak seen so far (of finished children)]
+        entry = [record, 0, 0]
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1][2] = max(stack[-1][2], peak)
+            tracemalloc.reset_peak()
+            entry[1] = entry[2] = current
+        stack.append(entry)
+        record.start = time.perf_counter()
+        return record
+
+    def _end(self, record):
+        end = time.perf_counter()
+        stack = self._stack()
+        entry = stack.pop()
+        record.duration = end - record.start
+        if self.memory:
+            _, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, entry[2])
+            record.peak_bytes = peak - entry[1]
+            if stack:
+                stack[-1][2] = max(stack[-1][2], peak)
+            tracemalloc.reset_peak()
+        if self.keep_records:
+            self.records.append(record)
+        for hook in self.hooks:
+            hook(record)
+
+    """
+    Per stage name: (count, total seconds, mean seconds, max seconds, max peak bytes or None)
+    """
+    def totals(self):
+        stats = collections.OrderedDict()
+        for record in sorted(self.records, key=lambda r: r.start):
+            count, total, longest, peak = stats.get(record.name, (0, 0.0, 0.0, None))
+            if record.peak_bytes is not None:
+                peak = max(peak or 0, record.peak_bytes)
+            stats[record.name] = (count + 1, total + record.duration, max(longest, record.duration), peak)
+        return collections.OrderedDict((name, (count, total, total / count, longest, peak))
+                                       for name, (count, total, longest, peak) in stats.items())
+
+    def summary(self):
+        lines = ["%-24s %8s %12s %12s %12s %12s" % ("Stage", "Count", "Total ms", "Mean ms", "Max ms", "Peak MB")]
+        for name, (count, total, mean, longest, peak) in self.totals().items():
+            peak = "-" if peak is None else "%.1f" % (peak / 1e6)
+            lines.append("%-24s %8d %12.2f %12.3f %12.3f %12s" % (name, count, total * 1e3, mean * 1e3, longest * 1e3, peak))
+        return "\n".join(lines) + "\n"
+
+    """
+    Chrome trace event format (complete events), viewable in chrome://tracing or ui.perfetto.dev
+    """
+    def chrome_trace(self):
+        pid = os.getpid()
+        events = []
+        for record in self.records:
+            args = dict((key, value if isinstance(value, (int, float, str)) else repr(value)) for key, value in record.args.items())
+            if record.frame is not None:
+                args['frame'] = record.frame
+            if record.peak_bytes is not None:
+                args['peak_bytes'] = record.peak_bytes
+            events.append({'name': record.name, 'ph': 'X', 'pid': pid, 'tid': record.thread,
+                           'ts': (record.start - self.origin) * 1e6, 'dur': record.duration * 1e6, 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, filename):
+        with open(filename, 'w') as fh:
+            json.dump(self.chrome_trace(), fh)
+
+_profiler = None
+
+"""
+Context manager timing one stage, a no-op unless a profiler is enabled
+"""
+def stage(name, **args):
+    if _profiler is None:
+        return _null_stage
+    return _profiler.stage(name, args)
+
+"""
+Stage covering all the work of one frame; stages inside it are attributed to frame_num
+"""
+def frame(frame_num):
+    if _profiler is None:
+        return _null_stage
+    return _profiler.stage('frame', {'frame': frame_num})
+
+def enable(profiler=None, memory=False):
+    global _profiler
+    if profiler is None:
+        profiler = Profiler(memory=memory)
+    disable()
+    profiler.start()
+    _profiler = profiler
+    return profiler
+
+def disable():
+    global _profiler
+    if _profiler is not None:
+        _profiler.stop()
+    _profiler = None
+
+def get_profiler():
+    return _profiler
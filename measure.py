@@ -16,77 +16,415 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import numpy
+from __future__ import print_function
+
+import argparse
+import atexit
+import itertools
+import json
 import re
 import sys
-import scipy.misc
 
 import vifp
 import ssim
 #import ssim_theano
 import psnr
-import niqe
 import reco
+import yuv
+import video
+import stream
+import align
+import sampling
+import tiles
+import filters
+import results
+import instrument
+import temporal
+import shard
 
-def img_greyscale(img):
-    return 0.299 * img[:,:,0] + 0.587 * img[:,:,1] + 0.114 * img[:,:,2]
+parser = argparse.ArgumentParser(description="Compare a distorted image or video to a reference")
+parser.add_argument("ref_file")
+parser.add_argument("dist_files", nargs="*", metavar="dist_file",
+                    help="distorted file; omitted with --write-eco.  A reference ECO sidecar (.npz) can be given "
+                         "in place of ref_file for reduced-reference RECO scoring of a .yuv dist_file.  Several .yuv "
+                         "files (e.g. a bitrate ladder) are scored together, analysing each reference frame once")
+parser.add_argument("--format", default="yuv420p", choices=sorted(yuv.FORMATS),
+                    help="pixel format of .yuv inputs (default: %(default)s)")
+parser.add_argument("--start", type=int, default=0, help="first frame to compare")
+parser.add_argument("--count", type=int, default=None, help="number of frames to compare (default: all)")
+parser.add_argument("--step", type=int, default=1, help="compare every n-th frame")
+parser.add_argument("--workers", type=int, default=1,
+                    help="number of processes scoring frames in parallel, 0 for one per CPU (default: %(default)s)")
+parser.add_argument("--chunksize", type=int, default=4,
+                    help="frames handed to a worker process at a time (default: %(default)s)")
+parser.add_argument("--size", metavar="WxH",
+                    help="resolution of video inputs (default: taken from the file name)")
+parser.add_argument("--buffers", type=int, default=4,
+                    help="frames decoded ahead when reading compressed video or stdin (default: %(default)s)")
+parser.add_argument("--metrics", default=",".join(video.DEFAULT_METRICS),
+                    help="comma-separated video metrics, from %s (default: %%(default)s)" % (", ".join(sorted(video.FRAME_METRICS))))
+parser.add_argument("--tolerance",
+                    help="sample frames until the confidence interval of the mean of each metric is narrower than +-TOLERANCE "
+                         "(one value, or comma-separated values per metric) instead of scoring every frame")
+parser.add_argument("--confidence", type=float, default=0.95, help="confidence level for --tolerance (default: %(default)s)")
+parser.add_argument("--stratum-size", type=int, default=100,
+                    help="with --tolerance, sample every run of this many frames separately (default: %(default)s)")
+parser.add_argument("--scene-cuts", action="store_true", help="with --tolerance, also start a new stratum at every scene cut")
+parser.add_argument("--align", action="store_true",
+                    help="match distorted frames to reference frames first, to handle dropped or duplicated frames")
+parser.add_argument("--search-window", type=int, default=8,
+                    help="with --align, search +-N frames around the expected reference frame (default: %(default)s)")
+parser.add_argument("--write-eco", metavar="SIDECAR",
+                    help="compute per-frame ECO of the reference .yuv and save it to SIDECAR (.npz) for reduced-reference RECO")
+parser.add_argument("--tile-size", type=int, default=None,
+                    help="score image inputs in tiles of this many pixels square, to bound memory on very large frames")
+parser.add_argument("--threads", type=int, default=1,
+                    help="with --tile-size, number of threads scoring image tiles (default: %(default)s)")
+parser.add_argument("--filter-threads", type=int, default=1,
+                    help="threads used by the filters within one frame, 0 for one per CPU (default: %(default)s)")
+parser.add_argument("--output-format", default="text", choices=results.FORMATS,
+                    help="per-frame results format (default: %(default)s)")
+parser.add_argument("--output", metavar="FILE", help="write per-frame results to FILE instead of stdout")
+parser.add_argument("--summary", metavar="FILE", help="also write the end-of-run aggregates to FILE as JSON")
+parser.add_argument("--profile", action="store_true", help="print time spent in each stage to stderr at the end of the run")
+parser.add_argument("--profile-memory", action="store_true", help="with --profile, also record peak allocated bytes per stage (slower)")
+parser.add_argument("--trace", metavar="FILE", help="with --profile, write a Chrome trace (chrome://tracing, Perfetto) to FILE")
+parser.add_argument("--planes", default="y", choices=("y", "yuv"),
+                    help="score luma only, or Y, U and V (at their native resolution) and their 6:1:1 weighted combination "
+                         "(default: %(default)s)")
+parser.add_argument("--temporal", type=int, metavar="N",
+                    help="also report the temporal metrics of video: frame-difference SSIM (TSSIM), temporal information "
+                         "(TI) and the TI-weighted SSIM over a sliding window of N frames (WINDOW_SSIM)")
+parser.add_argument("--shards", type=int, metavar="N",
+                    help="split a .yuv pair into N shards of consecutive frames, scored by --workers processes and merged "
+                         "(see shard.py)")
+parser.add_argument("--shard", type=int, metavar="I",
+                    help="with --shards, only score shard I (from 0) and write its partial result to --shard-output, "
+                         "for merging with python shard.py")
+parser.add_argument("--shard-output", metavar="FILE", help="partial result file of --shard")
 
-def img_read_yuv(src_file, width, height):
-    y_img = numpy.fromfile(src_file, dtype=numpy.uint8, count=(width * height)).reshape( (height, width) )
-    u_img = numpy.fromfile(src_file, dtype=numpy.uint8, count=((width/2) * (height/2))).reshape( (height/2, width/2) )
-    v_img = numpy.fromfile(src_file, dtype=numpy.uint8, count=((width/2) * (height/2))).reshape( (height/2, width/2) )
-    return (y_img, u_img, v_img)
+"""
+Check the arguments and fill in the derived ones; exits through parser.error on bad arguments
+"""
+def check_args(args):
+    if args.filter_threads != 1:
+        filters.set_backend('threaded', args.filter_threads or None)
+    args.metrics = tuple(args.metrics.split(","))
+    for name in args.metrics:
+        if name not in video.FRAME_METRICS:
+            parser.error("unknown metric: %s" % (name))
+    if args.tolerance is not None:
+        args.tolerance = [float(x) for x in args.tolerance.split(",")]
+        if len(args.tolerance) not in (1, len(args.metrics)):
+            parser.error("--tolerance needs one value, or one per metric (%d)" % (len(args.metrics)))
+        if args.planes == "yuv" and len(args.tolerance) > 1:
+            # Each metric's tolerance applies to all its planes and their combination (see video.plane_metric_names)
+            args.tolerance = [tolerance for tolerance in args.tolerance for _ in video.PLANES + ('yuv',)]
+    if args.workers == 0:
+        args.workers = None
+    if args.temporal is not None:
+        if args.temporal < 1:
+            parser.error("--temporal must be at least 1")
+        if args.workers != 1 or args.tolerance is not None:
+            parser.error("--temporal needs the frames in order, it cannot be used with --workers or --tolerance")
+    if args.shards is not None:
+        if args.shards < 1:
+            parser.error("--shards must be at least 1")
+        if args.align or args.tolerance is not None or args.temporal is not None or args.planes != "y":
+            parser.error("--shards cannot be used with --align, --tolerance, --temporal or --planes yuv")
+        if args.shard is not None and not (0 <= args.shard < args.shards and args.shard_output):
+            parser.error("--shard needs --shard-output and a shard number below --shards")
+    elif args.shard is not None:
+        parser.error("--shard needs --shards")
+    args.dist_file = args.dist_files[0] if args.dist_files else None
+    if args.dist_file is None and not args.write_eco:
+        parser.error("dist_file is required")
+    if len(args.dist_files) > 1:
+        if not all(".yuv" in filename and not stream.is_stream(filename) for filename in [args.ref_file] + args.dist_files):
+            parser.error("several dist files can only be scored against a .yuv reference")
+        for name in args.metrics:
+            if name not in video.ENCODE_METRICS:
+                parser.error("metric %s is not supported with several dist files, use %s" % (name, ", ".join(video.ENCODE_METRICS)))
+        if (args.workers != 1 or args.align or args.tolerance is not None or args.shards is not None
+                or args.temporal is not None or args.planes != "y" or args.write_eco):
+            parser.error("several dist files cannot be used with --workers, --align, --tolerance, --shards, --temporal, "
+                         "--planes yuv or --write-eco")
+    video_input = (args.write_eco or len(args.dist_files) > 1 or args.ref_file.endswith(".npz") or ".yuv" in args.ref_file
+                   or stream.is_stream(args.ref_file) or stream.is_stream(args.dist_file))
+    if video_input and (args.tile_size is not None or args.threads != 1):
+        parser.error("--tile-size and --threads only apply to image inputs, use --filter-threads or --workers for video")
 
-ref_file = sys.argv[1]
-dist_file = sys.argv[2]
+def start_profile(args):
+    if args.workers != 1:
+        print("Warning: --profile only records stages run in the main process, use --workers 1", file=sys.stderr)
+    profiler = instrument.enable(memory=args.profile_memory)
 
-if ".yuv" in ref_file:
-    # Inputs are uncompressed video in YUV420 planar format
+    def report_profile():
+        instrument.disable()
+        sys.stderr.write(profiler.summary())
+        if args.trace:
+            profiler.write_chrome_trace(args.trace)
+    atexit.register(report_profile)
 
-    # Get resolution from file name
-    m = re.search(r"(\d+)x(\d+)", ref_file)
-    if not m:
-        print "Could not find resolution in file name: %s" % (ref_file)
+def info(args, message):
+    # Keep stdout machine-readable when results in another format go there
+    info_fh = sys.stdout if args.output_format == "text" or args.output not in (None, "-") else sys.stderr
+    print(message, file=info_fh)
+
+def open_results(args, metrics, ref_frames=False):
+    try:
+        writer = results.open_writer(args.output_format, args.output, metrics, ref_frames)
+    except ValueError as e:
+        parser.error(str(e))
+    return writer, results.Summary(metrics)
+
+def close_results(args, writer, summary, result=None):
+    if result is None:
+        result = summary.result()
+    if not writer.write_summary(result):
+        sys.stderr.write(results.format_summary(result))
+    writer.close()
+    if args.summary:
+        with open(args.summary, "w") as fh:
+            json.dump(results.summary_json(result), fh, indent=2)
+
+def resolution_from_name(args, *filenames):
+    for filename in filenames:
+        m = re.search(r"(\d+)x(\d+)", args.size or filename)
+        if m:
+            return int(m.group(1)), int(m.group(2))
+    print("Could not find resolution in file name: %s" % (" or ".join(filenames)))
+    exit(1)
+
+"""
+Reduced-reference: compute the ECO signature of the reference video only
+"""
+def write_eco(args):
+    ref_file = args.ref_file
+    width, height = resolution_from_name(args, ref_file)
+    print("Computing ECO of %s, resolution %d x %d" % (ref_file, width, height))
+
+    reader = yuv.YuvReader(ref_file, width, height, args.format)
+    _, sigma = reco.kernel_params((height, width))
+    frame_nums = []
+    eco_values = []
+    for frame_num, (ref, _, _) in reader.frames(args.start, args.count, args.step):
+        frame_nums.append(frame_num)
+        eco_values.append(reco.eco(ref / float(reader.format.max_value), sigma))
+    reco.write_eco_sidecar(args.write_eco, frame_nums, eco_values, sigma, width, height, args.format)
+    print("Saved ECO of %d frames to %s" % (len(frame_nums), args.write_eco))
+
+"""
+Reduced-reference: score against the reference ECO signature written by --write-eco
+--start, --count and --step select the frames as for the other inputs; selected frames that have no ECO
+in the sidecar (it was written with its own selection) are skipped.
+"""
+def score_eco_sidecar(args):
+    ref_file, dist_file = args.ref_file, args.dist_file
+    sidecar = reco.read_eco_sidecar(ref_file)
+    width, height = sidecar['width'], sidecar['height']
+    info(args, "Comparing %s to %s, resolution %d x %d" % (ref_file, dist_file, width, height))
+
+    reader = yuv.YuvReader(dist_file, width, height, sidecar['format'])
+    eco_by_frame = dict(zip(sidecar['frames'].tolist(), sidecar['eco']))
+    writer, summary = open_results(args, ('reco',))
+    for frame_num in reader.frame_indices(args.start, args.count, args.step):
+        eco_ref = eco_by_frame.get(frame_num)
+        if eco_ref is None:
+            continue
+        dist, _, _ = reader.frame(frame_num)
+        reco_value = reco.reco_from_eco(eco_ref, dist / float(reader.format.max_value), sidecar['sigma'])
+        writer.write(frame_num, (reco_value,))
+        summary.add(frame_num, (reco_value,))
+    close_results(args, writer, summary)
+
+"""
+Compressed video or stdin, decoded to raw frames through a pipe and scored as they arrive
+"""
+def score_stream(args):
+    ref_file, dist_file = args.ref_file, args.dist_file
+    width, height = resolution_from_name(args, ref_file, dist_file)
+    info(args, "Comparing %s to %s, resolution %d x %d" % (ref_file, dist_file, width, height))
+
+    fmt = yuv.get_format(args.format)
+    metrics = args.metrics
+    names = video.plane_metric_names(metrics) if args.planes == "yuv" else metrics
+    scorer = None
+    if args.temporal is not None:
+        names += temporal.TEMPORAL_METRICS
+        scorer = temporal.TemporalScorer(args.temporal, fmt.max_value)
+    writer, summary = open_results(args, names)
+    stop = None if args.count is None else args.start + args.count * args.step
+    try:
+        with stream.open_video(ref_file, width, height, args.format, args.buffers) as ref_frames, \
+             stream.open_video(dist_file, width, height, args.format, args.buffers) as dist_frames:
+            frames = itertools.islice(zip(ref_frames, dist_frames), args.start, stop, args.step)
+            for (frame_num, ref_planes), (_, dist_planes) in frames:
+                if args.planes == "yuv":
+                    values = video.score_planes(ref_planes, dist_planes, metrics, fmt.max_value)
+                else:
+                    values = video.score_frame(ref_planes[0], dist_planes[0], metrics, fmt.max_value)
+                if scorer is not None:
+                    values += tuple(scorer.add(ref_planes[0], dist_planes[0], video.luma_value(values, metrics, 'ssim', args.planes)))
+                writer.write(frame_num, values)
+                summary.add(frame_num, values)
+    except stream.DecoderError as e:
+        writer.close()
+        print("Error: %s" % (e), file=sys.stderr)
         exit(1)
+    close_results(args, writer, summary)
+
+"""
+Uncompressed video in planar YUV format
+"""
+def score_yuv(args):
+    ref_file, dist_file = args.ref_file, args.dist_file
+    # Get resolution from file name
+    width, height = resolution_from_name(args, ref_file)
+    info(args, "Comparing %s to %s, resolution %d x %d" % (ref_file, dist_file, width, height))
+
+    pair = video.VideoPair(ref_file, dist_file, width, height, args.format)
+    if len(pair.ref) != len(pair.dist):
+        print("Warning: %s has %d frames, %s has %d frames" % (ref_file, len(pair.ref), dist_file, len(pair.dist)), file=sys.stderr)
 
-    width, height = int(m.group(1)), int(m.group(2))
-    print "Comparing %s to %s, resolution %d x %d" % (ref_file, dist_file, width, height)
+    metrics = args.metrics
+    names = video.plane_metric_names(metrics) if args.planes == "yuv" else metrics
+    if args.align:
+        alignment = align.align(align.Thumbnails(pair.ref), align.Thumbnails(pair.dist), args.search_window)
+        info(args, "Alignment: offset=%d dropped=%d duplicated=%d unmatched=%d" % (
+            alignment.offset, len(alignment.dropped), len(alignment.duplicated), len(alignment.unmatched)))
+        frame_indices = alignment.pairs[args.start::args.step][:args.count]
+    else:
+        frame_indices = pair.frame_indices(args.start, args.count, args.step)
 
-    ref_fh = open(ref_file, "rb")
-    dist_fh = open(dist_file, "rb")
+    if args.shards is not None:
+        if args.shard is not None:
+            partial = shard.run_shard(ref_file, dist_file, width, height, args.format, frame_indices, args.shards, args.shard,
+                                      metrics, args.shard_output)
+            info(args, "Saved shard %d of %d (%d frames) to %s" % (
+                args.shard, args.shards, len(partial['records']), args.shard_output))
+            return
+        merged = shard.run_local(ref_file, dist_file, width, height, args.format, frame_indices, metrics,
+                                 args.shards, args.workers)
+        writer, _ = open_results(args, merged.metrics)
+        close_results(args, writer, summary=None, result=shard.write_merged(merged, writer))
+        return
 
-    frame_num = 0
-    while True:
-        ref, _, _ = img_read_yuv(ref_fh, width, height)
-        dist, _, _ = img_read_yuv(dist_fh, width, height)
-        vifp_value = vifp.vifp_mscale(ref.astype(float), dist.astype(float))
-        ssim_value = ssim.ssim(ref, dist)
-        print "Frame=%d VIFP=%f SSIM=%f" % (frame_num, vifp_value, ssim_value)
-        frame_num += 1
+    if args.tolerance is not None:
+        if len(frame_indices) == 0:
+            print("Error: no frames to sample, check --start/--count/--step against the %d frames" % (len(pair)), file=sys.stderr)
+            exit(1)
+        # Estimate the means from a growing stratified sample of frame_indices
+        def score_positions(positions):
+            results = video.score_video(ref_file, dist_file, width, height, args.format, [frame_indices[p] for p in positions],
+                                        metrics, workers=args.workers, chunksize=args.chunksize, planes=args.planes)
+            return ((p, values) for p, (_, values) in zip(positions, results))
 
-else:
-    # Inputs are image files
-    ref = scipy.misc.imread(ref_file, flatten=True).astype(numpy.float32)
-    dist = scipy.misc.imread(dist_file, flatten=True).astype(numpy.float32)
+        cuts = ()
+        if args.scene_cuts:
+            thumbs = align.Thumbnails(pair.ref)
+            cuts = sampling.scene_cuts([thumbs[f[0] if isinstance(f, tuple) else f] for f in frame_indices])
+        result = sampling.sample_mean(score_positions, len(frame_indices), names, args.tolerance, args.confidence,
+                                      args.stratum_size, cuts)
+        for name, estimate in zip(names, result.estimates):
+            print("Mean %s=%f CI=[%f, %f]" % (name.upper(), estimate.mean, estimate.low, estimate.high))
+        print("Scored %d of %d frames (%.1f%%), confidence %g" % (len(result.scores), len(frame_indices), 100 * result.fraction, args.confidence))
+        return
 
-    width, height = ref.shape[1], ref.shape[0]
-    print "Comparing %s to %s, resolution %d x %d" % (ref_file, dist_file, width, height)
+    if args.temporal is not None:
+        names += temporal.TEMPORAL_METRICS
+    writer, summary = open_results(args, names, ref_frames=args.align)
+    scores = video.score_video(ref_file, dist_file, width, height, args.format, frame_indices, metrics,
+                               workers=args.workers, chunksize=args.chunksize, planes=args.planes,
+                               temporal_window=args.temporal)
+    for frame_num, values in scores:
+        ref_num = None
+        if isinstance(frame_num, tuple):
+            ref_num, frame_num = frame_num
+        writer.write(frame_num, values, ref_num)
+        summary.add(frame_num, values)
+    close_results(args, writer, summary)
+
+"""
+Several encodes of one .yuv reference; the values of encode i (from 1) are reported as metric_i
+"""
+def score_encodes(args):
+    ref_file, dist_files = args.ref_file, args.dist_files
+    width, height = resolution_from_name(args, ref_file)
+    info(args, "Comparing %s to %d encodes, resolution %d x %d" % (ref_file, len(dist_files), width, height))
+    for i, dist_file in enumerate(dist_files, 1):
+        info(args, "Encode %d: %s" % (i, dist_file))
+
+    metrics = args.metrics
+    names = tuple("%s_%d" % (name, i) for i in range(1, len(dist_files) + 1) for name in metrics)
+    num_frames = min(len(yuv.YuvReader(filename, width, height, args.format)) for filename in [ref_file] + dist_files)
+    frame_indices = range(args.start, num_frames, args.step)[:args.count]
+    writer, summary = open_results(args, names)
+    for frame_num, encode_values in video.score_encodes(ref_file, dist_files, width, height, args.format, frame_indices, metrics):
+        values = sum(encode_values, ())
+        writer.write(frame_num, values)
+        summary.add(frame_num, values)
+    close_results(args, writer, summary)
+
+"""
+Inputs are image files
+"""
+def score_images(args):
+    ref_file, dist_file = args.ref_file, args.dist_file
+    ref_planes = yuv.read_image(ref_file, args.planes)
+    dist_planes = yuv.read_image(dist_file, args.planes)
 
-    vifp_value = vifp.vifp_mscale(ref, dist)
-    print "VIFP=%f" % (vifp_value)
+    width, height = ref_planes[0].shape[1], ref_planes[0].shape[0]
+    print("Comparing %s to %s, resolution %d x %d" % (ref_file, dist_file, width, height))
 
-    ssim_value = ssim.ssim_exact(ref/255, dist/255)
-    print "SSIM=%f" % (ssim_value)
+    def image_metrics(ref, dist):
+        # Scaled to 0-1 once, for all the metrics that take it
+        ref_norm = ref / 255
+        dist_norm = dist / 255
+        values = []
+        if args.tile_size:
+            values.append(("VIFP", tiles.vifp_mscale(ref, dist, args.tile_size, args.threads)))
+            values.append(("SSIM", tiles.ssim_exact(ref_norm, dist_norm, tile_size=args.tile_size, threads=args.threads)))
+        else:
+            values.append(("VIFP", vifp.vifp_mscale(ref, dist)))
+            values.append(("SSIM", ssim.ssim_exact(ref_norm, dist_norm)))
+        values.append(("SSIM approx", ssim.ssim(ref_norm, dist_norm)))
+        values.append(("PSNR", psnr.psnr(ref, dist)))
+        # values.append(("NIQE", niqe.niqe(dist_norm)))
+        if args.tile_size:
+            values.append(("RECO", tiles.reco(ref_norm, dist_norm, tile_size=args.tile_size, threads=args.threads)))
+        else:
+            values.append(("RECO", reco.reco(ref_norm, dist_norm)))
+        return values
 
-    # FIXME this is buggy, disable for now
-    # ssim_value2 = ssim.ssim(ref/255, dist/255)
-    # print "SSIM approx=%f" % (ssim_value2)
+    plane_values = [image_metrics(ref, dist) for ref, dist in zip(ref_planes, dist_planes)]
+    if len(plane_values) == 1:
+        for name, value in plane_values[0]:
+            print("%s=%f" % (name, value))
+    else:
+        for i, (name, _) in enumerate(plane_values[0]):
+            values = [plane[i][1] for plane in plane_values]
+            print("%s=%f Y=%f U=%f V=%f" % (name, video.combine_planes(values), values[0], values[1], values[2]))
 
-    psnr_value = psnr.psnr(ref, dist)
-    print "PSNR=%f" % (psnr_value)
+def main():
+    args = parser.parse_args()
+    if args.profile:
+        start_profile(args)
+    check_args(args)
 
-    # niqe_value = niqe.niqe(dist/255)
-    # print "NIQE=%f" % (niqe_value)
+    if args.write_eco:
+        write_eco(args)
+    elif len(args.dist_files) > 1:
+        score_encodes(args)
+    elif args.ref_file.endswith(".npz"):
+        score_eco_sidecar(args)
+    elif stream.is_stream(args.ref_file) or stream.is_stream(args.dist_file):
+        score_stream(args)
+    elif ".yuv" in args.ref_file:
+        score_yuv(args)
+    else:
+        score_images(args)
 
-    reco_value = reco.reco(ref/255, dist/255)
-    print "RECO=%f" % (reco_value)
+# Worker processes started by spawn or forkserver import this module, and must not run the script again
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Video Quality Metrics
+Copyright (c) 2014 Alex Izvorski <aizvorski@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Several full-reference metrics of one image pair in a single pass
+
+All metrics share one moments.MomentsCache, so the pyramid levels and the local means, variances and
+covariance at each (scale, sd) are computed once no matter how many metrics use them (SSIM and the first
+MS-SSIM scale share their moments).
+
+Images are in their natural dynamic range (0-peak, e.g. 0-255), like vifp_mscale and psnr expect;
+SSIM gets its constants scaled by peak**2 instead of dividing the images by peak, which gives the same
+value as ssim_exact(ref/peak, dist/peak).
+"""
+
+import vifp
+import ssim
+import psnr
+import moments
+
+METRICS = ('vifp', 'ssim', 'msssim', 'psnr')
+
+def compute_metrics(ref, dist, metrics=METRICS, peak=255.0):
+    unknown = set(metrics) - set(METRICS)
+    if unknown:
+        raise ValueError("Unknown metrics: %s (supported: %s)" % (", ".join(sorted(unknown)), ", ".join(METRICS)))
+
+    cache = moments.MomentsCache(ref, dist)
+    results = {}
+    for name in metrics:
+        if name == 'vifp':
+            results[name] = vifp.vifp_mscale(ref, dist, cache=cache)
+        elif name == 'ssim':
+            results[name] = ssim.ssim_from_moments(cache.moments(1, 1.5), (0.01 * peak)**2, (0.03 * peak)**2)
+        elif name == 'msssim':
+            results[name] = ssim.msssim(ref, dist, C1=(0.01 * peak)**2, C2=(0.03 * peak)**2, cache=cache)
+        elif name == 'psnr':
+            results[name] = psnr.psnr(ref, dist, pixel_max=peak)
+    return results
@@ -0,0 +1,154 @@
+"""
+Video Quality Metrics
+Copyright (c) 2014 Alex Izvorski <aizvorski@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Local Gaussian-weighted moments of an image pair
+
+SSIM, VIFP and MS-SSIM are all built from the same five maps: local means of both images, their local
+variances and their local covariance.  local_moments() computes them with a single gaussian_filter call
+over a stack of img1, img2, img1^2, img2^2 and img1*img2, and MomentsCache keeps them per (scale, sd) so
+that several metrics evaluated on the same pair share them.
+
+Filtering is only along the last two (spatial) axes.
+"""
+
+import collections
+import numpy
+
+from filters import gaussian_filter
+import pyramid
+
+Moments = collections.namedtuple('Moments', ['mu1', 'mu2', 'sigma1_sq', 'sigma2_sq', 'sigma12'])
+
+def local_moments(img1, img2, sd, workspace=None, name='moments'):
+    dtype = numpy.result_type(img1.dtype, img2.dtype, numpy.float32)
+    shape = (5,) + img1.shape
+    if workspace is None:
+        stack = numpy.empty(shape, dtype=dtype)
+        maps = None
+        tmp = None
+    else:
+        stack = workspace.buffer((name, 'stack'), shape, dtype)
+        maps = workspace.buffer((name, 'maps'), shape, dtype)
+        tmp = workspace.buffer((name, 'tmp'), img1.shape, dtype)
+    stack[0] = img1
+    stack[1] = img2
+    numpy.multiply(img1, img1, out=stack[2])
+    numpy.multiply(img2, img2, out=stack[3])
+    numpy.multiply(img1, img2, out=stack[4])
+
+    sigma = (0,) * (stack.ndim - 2) + (sd, sd)
+    maps = gaussian_filter(stack, sigma, output=maps)
+    del stack
+
+    mu1, mu2 = maps[0], maps[1]
+    maps[2] -= numpy.multiply(mu1, mu1, out=tmp)
+    maps[3] -= numpy.multiply(mu2, mu2, out=tmp)
+    maps[4] -= numpy.multiply(mu1, mu2, out=tmp)
+    return Moments(*maps)
+
+"""
+local_moments split into the maps that depend on img1 only (mu1, sigma1_sq), computed once for a reference
+image, and the remaining maps for each img2 compared against it.  Together they give exactly local_moments().
+"""
+def single_moments(img, sd):
+    dtype = numpy.result_type(img.dtype, numpy.float32)
+    stack = numpy.empty((2,) + img.shape, dtype=dtype)
+    stack[0] = img
+    numpy.multiply(img, img, out=stack[1])
+
+    sigma = (0,) * (stack.ndim - 2) + (sd, sd)
+    maps = gaussian_filter(stack, sigma)
+    del stack
+
+    mu = maps[0]
+    maps[1] -= mu * mu
+    return mu, maps[1]
+
+def cross_moments(img1, mu1, sigma1_sq, img2, sd):
+    dtype = numpy.result_type(img1.dtype, img2.dtype, numpy.float32)
+    stack = numpy.empty((3,) + img2.shape, dtype=dtype)
+    stack[0] = img2
+    numpy.multiply(img2, img2, out=stack[1])
+    numpy.multiply(img1, img2, out=stack[2])
+
+    sigma = (0,) * (stack.ndim - 2) + (sd, sd)
+    maps = gaussian_filter(stack, sigma)
+    del stack
+
+    mu2 = maps[0]
+    maps[1] -= mu2 * mu2
+    maps[2] -= mu1 * mu2
+    return Moments(mu1, mu2, sigma1_sq, maps[1], maps[2])
+
+# Batched metrics filter this many pixels (summed over the images of a chunk) per call: enough frames of a
+# small video (6 at 320x240) that filters.gaussian_filter takes its matrix product path, while the moment
+# stacks stay around 20 MB; frames at least this large are processed one at a time
+BATCH_PIXELS = 512 * 1024
+
+"""
+Slices of the first axis of an (N, H, W) stack, in chunks of about BATCH_PIXELS pixels
+"""
+def batch_slices(shape, max_pixels=None):
+    if max_pixels is None:
+        max_pixels = BATCH_PIXELS
+    step = max(1, max_pixels // max(1, shape[-2] * shape[-1]))
+    return [slice(start, start + step) for start in range(0, shape[0], step)]
+
+"""
+Scratch buffers kept across calls (e.g. across the frames of a video), looked up by name, shape and dtype.
+Anything computed into a workspace is only valid until the next call that uses the same workspace.
+"""
+class Workspace(object):
+    def __init__(self):
+        self.buffers = {}
+
+    def buffer(self, name, shape, dtype):
+        key = (name, tuple(shape), numpy.dtype(dtype))
+        buf = self.buffers.get(key)
+        if buf is None:
+            buf = self.buffers[key] = numpy.empty(shape, dtype=dtype)
+        return buf
+
+    def clear(self):
+        self.buffers.clear()
+
+"""
+Moments of one image pair, computed at most once per (scale, sd, pyramid method)
+pyramids holds a pyramid.Pyramid of each image; level 1 is the full resolution pair.  Pass pyramids to share
+their levels with other metrics of the same images.
+The cached maps are shared between metrics, so they must not be modified.
+With a workspace, the maps and the 'vifp' levels live in its buffers instead of being allocated per pair.
+"""
+class MomentsCache(object):
+    def __init__(self, img1, img2, workspace=None, pyramids=None):
+        if pyramids is None:
+            pyramids = (pyramid.Pyramid(img1, workspace, ('level', 'img1')), pyramid.Pyramid(img2, workspace, ('level', 'img2')))
+        self.pyramids = pyramids
+        self.maps = {}
+        self.workspace = workspace
+
+    def level(self, scale, method='vifp'):
+        return self.pyramids[0].level(scale, method), self.pyramids[1].level(scale, method)
+
+    def moments(self, scale, sd, method='vifp'):
+        key = (scale, sd, method if scale > 1 else None)
+        if key not in self.maps:
+            img1, img2 = self.level(scale, method)
+            self.maps[key] = local_moments(img1, img2, sd, self.workspace, ('moments',) + key)
+        return self.maps[key]
@@ -21,19 +21,24 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 NIQE: Natural Image Quality Evaluator
 An excellent no-reference image quality metric.  
 Code below is roughly similar on Matlab code graciously provided by Anish Mittal, but is written from scratch (since most of the Matlab functions there don't have numpy equivalents).
-Training the model is not implemented yet, so we rely on pre-trained model parameters in file modelparameters.mat.
+By default we rely on pre-trained model parameters in file modelparameters.mat; niqe_train.py trains a new model from a corpus of pristine images.
 Cite:
 Mittal, Anish, Rajiv Soundararajan, and Alan C. Bovik. "Making a completely blind image quality analyzer." Signal Processing Letters, IEEE 20.3 (2013): 209-212.
 """
 
 import math
+import os
+import warnings
 import numpy
 import numpy.linalg
-from scipy.special import gamma
-from scipy.ndimage.filters import gaussian_filter
+from scipy.special import gamma, gammaln
 import scipy.misc
 import scipy.io
-import skimage.transform
+
+import instrument
+import moments
+import pyramid
+from filters import gaussian_filter
 
 """
 Generalized Gaussian distribution estimation.
@@ -49,12 +54,92 @@ Cite: Dominguez-Molina 2001, pg 7, eq (8)
 def generalized_gaussian_ratio(alpha):
     return (gamma(2.0/alpha)**2) / (gamma(1.0/alpha) * gamma(3.0/alpha))
 
+"""
+generalized_gaussian_ratio through log-gamma, which does not overflow for small alpha
+"""
+def _log_generalized_gaussian_ratio(alpha):
+    return 2 * gammaln(2.0/alpha) - gammaln(1.0/alpha) - gammaln(3.0/alpha)
+
+# Range of shapes of the 'table' and 'exact' inverses; the ratio increases from 0 to 0.75 with alpha
+ALPHA_MIN = 0.05
+ALPHA_MAX = 50.0
+# Shapes tabulated to bracket the 'exact' bisection
+BRACKET_SIZE = 1024
+# Entries of the 'table' inverse
+TABLE_SIZE = 4096
+
+_ratio_table = None
+_inverse_table = None
+
+"""
+(ratio, log alpha) at BRACKET_SIZE log-spaced shapes between ALPHA_MIN and ALPHA_MAX, computed on first use
+"""
+def _get_ratio_table():
+    global _ratio_table
+    if _ratio_table is None:
+        log_alpha = numpy.linspace(math.log(ALPHA_MIN), math.log(ALPHA_MAX), BRACKET_SIZE)
+        _ratio_table = (numpy.exp(_log_generalized_gaussian_ratio(numpy.exp(log_alpha))), log_alpha)
+    return _ratio_table
+
+def _logit(k):
+    return numpy.log(k / (0.75 - k))
 
 """
-Generalized Gaussian ratio function inverse (numerical approximation)
-Cite: Dominguez-Molina 2001, pg 13
+(u of the first entry, entries per unit of u, log alpha) of the 'table' inverse: log alpha at TABLE_SIZE
+evenly spaced u = log(k / (0.75 - k)) between the ratios of ALPHA_MIN and ALPHA_MAX, computed on first use
+by bisection.  Even spacing lets a lookup compute its entry instead of searching for it, and in u the
+inverse is smooth enough at both ends for linear interpolation.
 """
-def generalized_gaussian_ratio_inverse(k):
+def _get_inverse_table():
+    global _inverse_table
+    if _inverse_table is None:
+        u_min = _logit(generalized_gaussian_ratio(ALPHA_MIN))
+        u_max = _logit(generalized_gaussian_ratio(ALPHA_MAX))
+        u = numpy.linspace(u_min, u_max, TABLE_SIZE)
+        k = 0.75 / (1 + numpy.exp(-u))
+        _inverse_table = (u_min, (TABLE_SIZE - 1) / (u_max - u_min), numpy.log(_ggrf_inverse_bisect(k)))
+    return _inverse_table
+
+GGRF_INVERSE_METHODS = ('approx', 'table', 'exact')
+
+"""
+Generalized Gaussian ratio function inverse
+Accepts a scalar or an array of ratios; the inverse is undefined (nan) for k >= 0.75.
+method:
+    'approx'  piecewise numerical approximation (Dominguez-Molina 2001, pg 13), relative error up to
+              2e-2 for alpha 0.2-5, nan for ratios just below 0.75; the pre-trained NIQE model was fitted
+              with it, so it is the default
+    'table'   linear interpolation of log alpha in a table of the inverse, relative error below 1e-6
+              (3e-7 measured); about 1.7 times as fast as 'approx'
+    'exact'   bisection of the ratio function, all ratios at once, relative error below 1e-12
+With 'table' and 'exact', alpha is clipped to ALPHA_MIN-ALPHA_MAX and is nan for k <= 0.
+"""
+def generalized_gaussian_ratio_inverse(k, method='approx'):
+    if method not in GGRF_INVERSE_METHODS:
+        raise ValueError("Unknown GGRF inverse method %s, expected one of %s" % (method, ", ".join(GGRF_INVERSE_METHODS)))
+    k = numpy.asarray(k, dtype=numpy.float64)
+    if method == 'approx':
+        alpha = _ggrf_inverse_approx(k)
+    else:
+        with numpy.errstate(all='ignore'):
+            valid = (k > 0) & (k < 0.75)
+        if method == 'table':
+            # Looked up for every element (the invalid ones at an arbitrary ratio), then masked
+            alpha = _ggrf_inverse_table(numpy.where(valid, k, 0.5))
+            alpha[~valid] = numpy.nan
+        else:
+            alpha = numpy.full(k.shape, numpy.nan)
+            alpha[valid] = _ggrf_inverse_bisect(k[valid])
+
+    undefined = numpy.count_nonzero(~(k < 0.75))
+    if undefined > 0:
+        warnings.warn("GGRF inverse is not defined for %d ratio(s) >= 0.75" % (undefined), RuntimeWarning, stacklevel=2)
+
+    if alpha.ndim == 0:
+        return float(alpha)
+    return alpha
+
+def _ggrf_inverse_approx(k):
     a1 = -0.535707356
     a2 = 1.168939911
     a3 = -0.1516189217
@@ -65,96 +150,240 @@ def generalized_gaussian_ratio_inverse(k):
     c2 = 0.6723532
     c3 = 0.033834
 
-    if k < 0.131246:
-        return 2 * math.log(27.0/16.0) / math.log(3.0/(4*k**2))
-    elif k < 0.448994:
-        return (1/(2 * a1)) * (-a2 + math.sqrt(a2**2 - 4*a1*a3 + 4*a1*k))
-    elif k < 0.671256:
-        return (1/(2*b3*k)) * (b1 - b2*k - math.sqrt((b1 - b2*k)**2 - 4*b3*(k**2)))
-    elif k < 0.75:
-        #print "%f %f %f" % (k, ((3-4*k)/(4*c1)), c2**2 + 4*c3*log((3-4*k)/(4*c1)) )
-        return (1/(2*c3)) * (c2 - math.sqrt(c2**2 + 4*c3*math.log((3-4*k)/(4*c1))))
-    else:
-        print("warning: GGRF inverse of %f is not defined" %(k))
-        return numpy.nan
+    # Every branch is evaluated on every element and the right one selected, so silence
+    # the invalid-value warnings of branches evaluated outside their range
+    with numpy.errstate(all='ignore'):
+        return numpy.select(
+            [k < 0.131246, k < 0.448994, k < 0.671256, k < 0.75],
+            [2 * numpy.log(27.0/16.0) / numpy.log(3.0/(4*k**2)),
+             (1/(2 * a1)) * (-a2 + numpy.sqrt(a2**2 - 4*a1*a3 + 4*a1*k)),
+             (1/(2*b3*k)) * (b1 - b2*k - numpy.sqrt((b1 - b2*k)**2 - 4*b3*(k**2))),
+             (1/(2*c3)) * (c2 - numpy.sqrt(c2**2 + 4*c3*numpy.log((3-4*k)/(4*c1))))],
+            numpy.nan)
+
+def _ggrf_inverse_table(k):
+    u_min, scale, log_alpha = _get_inverse_table()
+    x = numpy.asarray(_logit(k))
+    x -= u_min
+    x *= scale
+    numpy.clip(x, 0, len(log_alpha) - 1, out=x)
+    i = numpy.minimum(x.astype(numpy.intp), len(log_alpha) - 2)
+    x -= i
+    lo = log_alpha[i]
+    x *= log_alpha[i + 1] - lo
+    x += lo
+    return numpy.exp(x, out=x)
+
+"""
+Bisection on log alpha for every element of k (0 < k < 0.75) at once, starting from the table bracket
+"""
+def _ggrf_inverse_bisect(k):
+    ratio, log_alpha = _get_ratio_table()
+    i = numpy.clip(numpy.searchsorted(ratio, k), 1, len(ratio) - 1)
+    lo, hi = log_alpha[i - 1], log_alpha[i]
+    log_k = numpy.log(k)
+    # The bracket is (log ALPHA_MAX - log ALPHA_MIN) / BRACKET_SIZE wide, 45 halvings take it below 1e-15
+    for _ in range(45):
+        mid = 0.5 * (lo + hi)
+        below = _log_generalized_gaussian_ratio(numpy.exp(mid)) < log_k
+        lo = numpy.where(below, mid, lo)
+        hi = numpy.where(below, hi, mid)
+    return numpy.exp(0.5 * (lo + hi))
 
 """
 Estimate the parameters of an asymmetric generalized Gaussian distribution
+method: of generalized_gaussian_ratio_inverse
+"""
+def estimate_aggd_params(x, method='approx'):
+    alpha, beta_left, beta_right = estimate_aggd_params_batch(x[numpy.newaxis], method)
+    return alpha[0], beta_left[0], beta_right[0]
+
 """
-def estimate_aggd_params(x):
-    x_left = x[x < 0]
-    x_right = x[x >= 0]
-    stddev_left = math.sqrt((1.0/(x_left.size - 1)) * numpy.sum(x_left ** 2))
-    stddev_right = math.sqrt((1.0/(x_right.size - 1)) * numpy.sum(x_right ** 2))
-    if stddev_right == 0:
-        return 1, 0, 0 # TODO check this
-    r_hat = numpy.mean(numpy.abs(x))**2 / numpy.mean(x**2)
-    y_hat = stddev_left / stddev_right
-    R_hat = r_hat * (y_hat**3 + 1) * (y_hat + 1) / ((y_hat**2 + 1) ** 2)
-    alpha = generalized_gaussian_ratio_inverse(R_hat)
-    beta_left = stddev_left * math.sqrt(gamma(3.0/alpha) / gamma(1.0/alpha))
-    beta_right = stddev_right * math.sqrt(gamma(3.0/alpha) / gamma(1.0/alpha))
+Estimate the parameters of an asymmetric generalized Gaussian distribution for each x[i] at once
+Returns arrays alpha, beta_left, beta_right of length x.shape[0]
+"""
+def estimate_aggd_params_batch(x, method='approx'):
+    x = x.reshape(x.shape[0], -1)
+    x_left = numpy.minimum(x, 0)
+    x_right = numpy.maximum(x, 0)
+    count_left = numpy.count_nonzero(x < 0, axis=1)
+    count_right = x.shape[1] - count_left
+    # Row-wise sums of squares as dot products, without materializing x**2
+    sum_left = numpy.einsum('ij,ij->i', x_left, x_left)
+    sum_right = numpy.einsum('ij,ij->i', x_right, x_right)
+    mean_abs = (numpy.sum(x_right, axis=1) - numpy.sum(x_left, axis=1)) / x.shape[1]
+    mean_sq = (sum_left + sum_right) / x.shape[1]
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        stddev_left = numpy.sqrt((1.0/(count_left - 1)) * sum_left)
+        stddev_right = numpy.sqrt((1.0/(count_right - 1)) * sum_right)
+        degenerate = stddev_right == 0 # TODO check this
+        r_hat = mean_abs**2 / mean_sq
+        y_hat = stddev_left / stddev_right
+        R_hat = r_hat * (y_hat**3 + 1) * (y_hat + 1) / ((y_hat**2 + 1) ** 2)
+        alpha = generalized_gaussian_ratio_inverse(R_hat[~degenerate], method)
+        alpha = _fill(degenerate, alpha, 1.0)
+        gamma_ratio = numpy.sqrt(gamma(3.0/alpha) / gamma(1.0/alpha))
+        beta_left = numpy.where(degenerate, 0.0, stddev_left * gamma_ratio)
+        beta_right = numpy.where(degenerate, 0.0, stddev_right * gamma_ratio)
     return alpha, beta_left, beta_right
 
-def compute_features(img_norm):
+def _fill(mask, values, fill_value):
+    out = numpy.full(mask.shape, fill_value)
+    out[~mask] = values
+    return out
+
+def compute_features(img_norm, method='approx'):
+    return list(compute_features_batch(img_norm[numpy.newaxis], method)[0])
+
+"""
+NIQE features of a stack of blocks, shape (n_blocks, block_size, block_size)
+Returns an (n_blocks, 18) feature matrix, row i being compute_features(blocks[i])
+method: of generalized_gaussian_ratio_inverse
+"""
+def compute_features_batch(blocks, method='approx'):
     features = []
-    alpha, beta_left, beta_right = estimate_aggd_params(img_norm)
+    alpha, beta_left, beta_right = estimate_aggd_params_batch(blocks, method)
 
     features.extend([ alpha, (beta_left+beta_right)/2 ])
 
     for x_shift, y_shift in ((0,1), (1,0), (1,1), (1,-1)):
-        img_pair_products  = img_norm * numpy.roll(numpy.roll(img_norm, y_shift, axis=0), x_shift, axis=1)
-        alpha, beta_left, beta_right = estimate_aggd_params(img_pair_products)
+        pair_products = blocks * numpy.roll(numpy.roll(blocks, y_shift, axis=1), x_shift, axis=2)
+        alpha, beta_left, beta_right = estimate_aggd_params_batch(pair_products, method)
         eta = (beta_right - beta_left) * (gamma(2.0/alpha) / gamma(1.0/alpha))
         features.extend([ alpha, eta, beta_left, beta_right ])
 
-    return features
+    return numpy.stack(features, axis=1)
+
+"""
+Split an image into non-overlapping block_size x block_size blocks, in row-major order,
+dropping any partial blocks at the right and bottom edges
+"""
+def image_blocks(img, block_size):
+    rows = img.shape[0] // block_size
+    cols = img.shape[1] // block_size
+    blocks = img[:rows*block_size, :cols*block_size].reshape(rows, block_size, cols, block_size)
+    return blocks.swapaxes(1, 2).reshape(rows * cols, block_size, block_size)
+
+"""
+Local mean and standard deviation, with Gaussian weighting
+With a workspace (moments.Workspace), the result arrays are reused across calls.
+"""
+def local_mean_std(img, sigma=7/6, workspace=None):
+    if workspace is None:
+        mu  = gaussian_filter(img, sigma, mode='nearest')
+        mu_sq = mu * mu
+        std = numpy.sqrt(numpy.abs(gaussian_filter(img * img, sigma, mode='nearest') - mu_sq))
+        return mu, std
 
-def normalize_image(img, sigma=7/6):
-    mu  = gaussian_filter(img, sigma, mode='nearest')
-    mu_sq = mu * mu
-    sigma = numpy.sqrt(numpy.abs(gaussian_filter(img * img, sigma, mode='nearest') - mu_sq))
-    img_norm = (img - mu) / (sigma + 1)
+    buf = lambda name: workspace.buffer(('niqe', name), img.shape, img.dtype)
+    mu = gaussian_filter(img, sigma, mode='nearest', output=buf('mu'))
+    img_sq = numpy.multiply(img, img, out=buf('tmp'))
+    std = gaussian_filter(img_sq, sigma, mode='nearest', output=buf('std'))
+    std -= numpy.multiply(mu, mu, out=img_sq)
+    numpy.abs(std, out=std)
+    numpy.sqrt(std, out=std)
+    return mu, std
+
+"""
+Divisive normalization (MSCN coefficients)
+With a workspace (moments.Workspace), the intermediate and result arrays are reused across calls.
+"""
+def normalize_image(img, sigma=7/6, workspace=None):
+    mu, std = local_mean_std(img, sigma, workspace)
+    if workspace is None:
+        img_norm = (img - mu) / (std + 1)
+        return img_norm
+
+    std += 1
+    img_norm = numpy.subtract(img, mu, out=workspace.buffer(('niqe', 'norm'), img.shape, img.dtype))
+    img_norm /= std
     return img_norm
 
+MODEL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'modelparameters.mat')
+
+_models = {}
 
-def niqe(img):
-    model_mat = scipy.io.loadmat('modelparameters.mat')
-    model_mu = model_mat['mu_prisparam']
-    model_cov = model_mat['cov_prisparam']
-
-    features = None
-    img_scaled = img
-    for scale in [1,2]:
-
-        if scale != 1:
-            img_scaled = skimage.transform.rescale(img, 1/scale)
-            #img_scaled = scipy.misc.imresize(img_norm, 0.5)
-
-        # print img_scaled
-        img_norm = normalize_image(img_scaled)
-
-        scale_features = []
-        block_size = 96//scale
-        for block_col in range(img_norm.shape[0]//block_size):
-            for block_row in range(img_norm.shape[1]//block_size):
-                block_features = compute_features( img_norm[block_col*block_size:(block_col+1)*block_size, block_row*block_size:(block_row+1)*block_size] )
-                scale_features.append(block_features)
-        # print "len(scale_features)=%f" %(len(scale_features))
-        if features is None:
-            features = numpy.vstack(scale_features)
-            # print features.shape
+"""
+Load NIQE model parameters (mu_prisparam, cov_prisparam) from a .mat or .npz file, once per file
+"""
+def load_model(filename=MODEL_FILE):
+    filename = os.path.abspath(filename)
+    if filename not in _models:
+        if filename.endswith('.npz'):
+            model = numpy.load(filename)
         else:
-            features = numpy.hstack([features, numpy.vstack(scale_features)])
-            # print features.shape
-        
-    features_mu = numpy.mean(features, axis=0)
-    features_cov = numpy.cov(features.T)
+            model = scipy.io.loadmat(filename)
+        _models[filename] = (numpy.ravel(model['mu_prisparam']), numpy.asarray(model['cov_prisparam']))
+    return _models[filename]
+
+"""
+NIQE scorer holding one model, for scoring many images (e.g. every frame of a video)
+model: a model file name, a (mu, cov) pair, or None for the shipped modelparameters.mat
+method: of generalized_gaussian_ratio_inverse; the model should have been fitted with the same one (the shipped
+model was fitted with 'approx')
+Images should be greyscale, 0-1 range.  Buffers for the normalization stage are kept between
+calls, so scoring images of the same resolution does not reallocate them.
+"""
+class NiqeScorer(object):
+    def __init__(self, model=None, method='approx'):
+        if method not in GGRF_INVERSE_METHODS:
+            raise ValueError("Unknown GGRF inverse method %s, expected one of %s" % (method, ", ".join(GGRF_INVERSE_METHODS)))
+        if model is None:
+            model = MODEL_FILE
+        if isinstance(model, str):
+            model_mu, model_cov = load_model(model)
+        else:
+            model_mu, model_cov = model
+        self.model_mu = numpy.ravel(model_mu)
+        self.model_cov = numpy.asarray(model_cov)
+        self.method = method
+        self.workspace = moments.Workspace()
+
+    """
+    levels: a pyramid.Pyramid of img, to share its levels with other metrics
+    """
+    def features(self, img, levels=None):
+        if levels is None:
+            levels = pyramid.Pyramid(img)
+        features = None
+        for scale in [1,2]:
+            with instrument.stage('niqe.scale', scale=scale):
+
+                img_scaled = levels.level(scale, 'rescale')
+                #img_scaled = scipy.misc.imresize(img_norm, 0.5)
+
+                img_norm = normalize_image(img_scaled, workspace=self.workspace)
+
+                block_size = 96//scale
+                scale_features = compute_features_batch(image_blocks(img_norm, block_size), self.method)
+            if features is None:
+                features = scale_features
+            else:
+                features = numpy.hstack([features, scale_features])
+        return features
+
+    def score(self, img, levels=None):
+        features = self.features(img, levels)
+        features_mu = numpy.mean(features, axis=0)
+        features_cov = numpy.cov(features.T)
+
+        pseudoinv_of_avg_cov  = numpy.linalg.pinv((self.model_cov + features_cov)/2)
+        diff = self.model_mu - features_mu
+        niqe_quality = math.sqrt( diff.dot( pseudoinv_of_avg_cov.dot(diff) ) )
+
+        return niqe_quality
+
+    def score_batch(self, imgs):
+        return numpy.array([self.score(img) for img in imgs])
 
-    pseudoinv_of_avg_cov  = numpy.linalg.pinv((model_cov + features_cov)/2)
-    niqe_quality = math.sqrt( (model_mu - features_mu).dot( pseudoinv_of_avg_cov.dot( (model_mu - features_mu).T ) ) )
+# Scorer of the shipped model for each GGRF inverse method
+_default_scorers = {}
 
-    return niqe_quality
+def niqe(img, levels=None, method='approx'):
+    if method not in _default_scorers:
+        _default_scorers[method] = NiqeScorer(method=method)
+    return _default_scorers[method].score(img, levels)
 
 # import sys
 # img = scipy.misc.imread(sys.argv[1], flatten=True).astype(numpy.float)/255.0
@@ -0,0 +1,181 @@
+from __future__ import division
+from __future__ import print_function
+
+"""
+Video Quality Metrics
+Copyright (c) 2015 Alex Izvorski <aizvorski@gmail.com>
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+NIQE model training
+Fits the multivariate Gaussian (mu_prisparam, cov_prisparam) of NIQE features over a corpus of pristine images.
+As in the paper, only the sharpest patches of each image are used: those whose summed local deviation is above
+sharpness_threshold times that of the sharpest patch in the image.  Images are processed in parallel, and the
+mean and covariance are accumulated incrementally, so only one image's features are in memory per process.
+
+Usage: python niqe_train.py [--workers N] pristine_images_dir model.mat (or model.npz)
+The model can then be used with niqe.NiqeScorer(model='model.mat').
+
+Cite:
+Mittal, Anish, Rajiv Soundararajan, and Alan C. Bovik. "Making a completely blind image quality analyzer." Signal Processing Letters, IEEE 20.3 (2013): 209-212.
+"""
+
+import argparse
+import multiprocessing
+import os
+import numpy
+import scipy.io
+
+import niqe
+import pyramid
+import yuv
+
+IMAGE_EXTENSIONS = ('.png', '.bmp', '.tif', '.tiff', '.jpg', '.jpeg', '.ppm', '.pgm')
+
+"""
+Running mean and covariance of feature vectors, mergeable across processes
+Cite: Chan, Golub and LeVeque, "Updating formulae and a pairwise algorithm for computing sample variances" (1979)
+"""
+class FeatureStats(object):
+    def __init__(self, num_features=36):
+        self.count = 0
+        self.mean = numpy.zeros(num_features)
+        self.m2 = numpy.zeros((num_features, num_features))
+
+    def add(self, features):
+        if features.shape[0] == 0:
+            return
+        other = FeatureStats(features.shape[1])
+        other.count = features.shape[0]
+        other.mean = numpy.mean(features, axis=0)
+        deviations = features - other.mean
+        other.m2 = deviations.T.dot(deviations)
+        self.merge(other)
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.m2 = self.m2 + other.m2 + numpy.outer(delta, delta) * (self.count * other.count / count)
+        self.count = count
+
+    """
+    Sample covariance, same normalization as numpy.cov
+    """
+    def cov(self):
+        return self.m2 / (self.count - 1)
+
+def read_image(filename):
+    return yuv.read_image(filename)[0].astype(numpy.float64)/255.0
+
+"""
+Features of the sharp patches of one image, one row per selected patch
+The same patches are used at both scales, selected by their sharpness at scale 1.
+method: of niqe.generalized_gaussian_ratio_inverse
+"""
+def image_features(img, block_size=96, sharpness_threshold=0.75, method='approx'):
+    features = []
+    levels = pyramid.Pyramid(img)
+    for scale in [1,2]:
+
+        img_scaled = levels.level(scale, 'rescale')
+
+        mu, std = niqe.local_mean_std(img_scaled)
+        img_norm = (img_scaled - mu) / (std + 1)
+
+        size = block_size//scale
+        if scale == 1:
+            rows, cols = img.shape[0]//size, img.shape[1]//size
+            sharpness = numpy.sum(niqe.image_blocks(std, size), axis=(1, 2))
+            selected = sharpness > sharpness_threshold * numpy.max(sharpness)
+
+        blocks = niqe.image_blocks(img_norm[:rows*size, :cols*size], size)
+        features.append(niqe.compute_features_batch(blocks[selected], method))
+
+    features = numpy.hstack(features)
+    return features[numpy.all(numpy.isfinite(features), axis=1)]
+
+def _file_stats(args):
+    filename, block_size, sharpness_threshold, method = args
+    stats = FeatureStats()
+    img = read_image(filename)
+    if img.shape[0] >= block_size and img.shape[1] >= block_size:
+        stats.add(image_features(img, block_size, sharpness_threshold, method))
+    return filename, stats
+
+def image_files(directory):
+    filenames = []
+    for dirpath, _, files in os.walk(directory):
+        for name in files:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                filenames.append(os.path.join(dirpath, name))
+    return sorted(filenames)
+
+"""
+Train a NIQE model from image files, returns (mu, cov)
+workers=1 runs in this process; workers=None uses one process per CPU.
+method: GGRF inverse of the features, to be scored with niqe.NiqeScorer(model, method=method)
+"""
+def train_model(filenames, block_size=96, sharpness_threshold=0.75, workers=None, verbose=False, method='approx'):
+    stats = FeatureStats()
+    tasks = [(filename, block_size, sharpness_threshold, method) for filename in filenames]
+    if workers == 1:
+        results = (_file_stats(task) for task in tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(workers)
+        # In file order, so that the merged statistics (and the model) do not depend on scheduling
+        results = pool.imap(_file_stats, tasks)
+    try:
+        for filename, file_stats in results:
+            if verbose:
+                print("%s: %d patches" % (filename, file_stats.count))
+            stats.merge(file_stats)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    if stats.count < 2:
+        raise ValueError("Not enough sharp patches to train a model (found %d)" % (stats.count))
+    return stats.mean, stats.cov()
+
+"""
+Save a model in the same layout as modelparameters.mat, as .npz if the file name ends in .npz
+"""
+def save_model(filename, mu, cov):
+    if filename.endswith('.npz'):
+        numpy.savez(filename, mu_prisparam=mu.reshape(1, -1), cov_prisparam=cov)
+    else:
+        scipy.io.savemat(filename, {'mu_prisparam': mu.reshape(1, -1), 'cov_prisparam': cov})
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train a NIQE model from a directory of pristine images")
+    parser.add_argument("image_dir")
+    parser.add_argument("model_file", help="output model, .mat or .npz")
+    parser.add_argument("--workers", type=int, default=0, help="number of processes, 0 for one per CPU (default: %(default)s)")
+    parser.add_argument("--block-size", type=int, default=96, help="patch size at scale 1 (default: %(default)s)")
+    parser.add_argument("--sharpness-threshold", type=float, default=0.75,
+                        help="keep patches sharper than this fraction of the sharpest patch (default: %(default)s)")
+    parser.add_argument("--ggrf-method", default="approx", choices=niqe.GGRF_INVERSE_METHODS,
+                        help="inverse of the generalized Gaussian ratio used for the features (default: %(default)s)")
+    args = parser.parse_args()
+
+    filenames = image_files(args.image_dir)
+    print("Training on %d images from %s" % (len(filenames), args.image_dir))
+    mu, cov = train_model(filenames, args.block_size, args.sharpness_threshold, workers=args.workers or None, verbose=True,
+                          method=args.ggrf_method)
+    save_model(args.model_file, mu, cov)
+    print("Saved model to %s" % (args.model_file))
@@ -0,0 +1,100 @@
+"""
+Video Quality Metrics
+Copyright (c) 2014 Alex Izvorski <aizvorski@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Image pyramids shared between multi-scale metrics
+
+A Pyramid holds the downsampled levels of one image, each computed on first use and kept for the
+lifetime of the pyramid, so every metric that asks for the same level gets the same array.  Level 1 is
+the image itself and level n is 2**(n-1) times smaller.
+
+The metrics were published with different downsampling filters, and each keeps its own so that the
+values stay comparable with the reference implementations; levels are shared between metrics that use
+the same method:
+    'vifp'     Gaussian blur (sd depends on the level, see vifp_sd) and decimation, each level from the
+               previous one (VIFP)
+    'box'      2x2 average and decimation, each level from the previous one (MS-SSIM)
+    'rescale'  skimage.transform.rescale of the full resolution image (NIQE)
+
+The cached levels must not be modified.
+"""
+
+import numpy
+
+import filters
+
+METHODS = ('vifp', 'box', 'rescale')
+
+"""
+Gaussian blur applied before decimating to level scale of the VIFP pyramid; it is also the sd of the
+VIFP moments window at that scale
+"""
+def vifp_sd(scale):
+    N = 2**(4-scale+1) + 1
+    return N/5.0
+
+"""
+filters.gaussian_filter(img, sd)[..., ::2, ::2], blurring only the last two axes
+With a workspace (moments.Workspace), the result is written into its buffer name.
+"""
+def blur_decimate(img, sd, workspace=None, name=None):
+    sd = (0,) * (img.ndim - 2) + (sd, sd)
+    if workspace is None:
+        return filters.gaussian_filter(img, sd)[..., ::2, ::2]
+    blurred = filters.gaussian_filter(img, sd, output=workspace.buffer('blur', img.shape, img.dtype))
+    blurred = blurred[..., ::2, ::2]
+    out = workspace.buffer(name, blurred.shape, img.dtype)
+    out[...] = blurred
+    return out
+
+"""
+Mean of every 2x2 block, odd sizes padded by repeating the last row or column
+(Matlab's imfilter(img, ones(2)/4, 'symmetric') followed by img(1:2:end, 1:2:end))
+"""
+def box_decimate(img):
+    h, w = img.shape[-2:]
+    if h % 2 or w % 2:
+        img = numpy.pad(img, [(0, 0)] * (img.ndim - 2) + [(0, h % 2), (0, w % 2)], mode='edge')
+    return 0.25 * (img[..., ::2, ::2] + img[..., 1::2, ::2] + img[..., ::2, 1::2] + img[..., 1::2, 1::2])
+
+class Pyramid(object):
+    """
+    workspace: a moments.Workspace for the 'vifp' levels, name: prefix of their buffer names
+    """
+    def __init__(self, img, workspace=None, name='pyramid'):
+        self.img = img
+        self.workspace = workspace
+        self.name = name
+        self.levels = {}
+
+    def level(self, scale, method='vifp'):
+        if scale == 1:
+            return self.img
+        if method not in METHODS:
+            raise ValueError("Unknown pyramid method %s, expected one of %s" % (method, ", ".join(METHODS)))
+        key = (method, scale)
+        if key not in self.levels:
+            if method == 'vifp':
+                self.levels[key] = blur_decimate(self.level(scale - 1, method), vifp_sd(scale), self.workspace, (self.name, scale))
+            elif method == 'box':
+                self.levels[key] = box_decimate(self.level(scale - 1, method))
+            else:
+                # Only NIQE needs scikit-image
+                import skimage.transform
+                self.levels[key] = skimage.transform.rescale(self.img, 0.5**(scale - 1))
+        return self.levels[key]
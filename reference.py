@@ -0,0 +1,85 @@
+"""
+Video Quality Metrics
+Copyright (c) 2014 Alex Izvorski <aizvorski@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Reference-side features for scoring many distorted versions against one reference
+
+ReferenceFeatures computes everything in VIFP and SSIM that depends only on the reference frame once: the VIFP
+pyramid, the local means and variances at every scale and the VIFP denominator, and the reference's box sums
+of SSIM.  Each comparison then only filters the distorted image and the cross term.  Results are identical
+to vifp_mscale() and to the video metric 'ssim' (ssim.ssim with constants scaled by peak**2); ssim_exact()
+gives the Gaussian-window SSIM on images divided by peak (up to rounding).
+"""
+
+import numpy
+
+import moments
+import pyramid
+import vifp
+import ssim
+
+class ReferenceFeatures(object):
+    def __init__(self, ref, peak=255.0, ssim_sd=1.5):
+        self.ref = ref
+        self.peak = peak
+
+        self.vifp_scales = []
+        self.vifp_den = 0.0
+        self.pyramid = pyramid.Pyramid(ref)
+        for scale in range(1, 5):
+            sd = pyramid.vifp_sd(scale)
+            level = self.pyramid.level(scale)
+            mu1, sigma1_sq = moments.single_moments(level, sd)
+            self.vifp_scales.append((sd, level, mu1, sigma1_sq))
+            self.vifp_den += vifp.vifp_den(sigma1_sq)
+
+        self.ssim_box = ssim.box_moments(ref)
+        self.ssim_sd = ssim_sd
+        self.ssim_mu1 = self.ssim_sigma1_sq = None
+
+    """
+    dist_levels: a pyramid.Pyramid of dist, to share its levels with other metrics
+    """
+    def vifp(self, dist, dist_levels=None):
+        if dist_levels is None:
+            dist_levels = pyramid.Pyramid(dist)
+        num = 0.0
+        for scale, (sd, level, mu1, sigma1_sq) in enumerate(self.vifp_scales, 1):
+            scale_num, _ = vifp.vifp_terms(moments.cross_moments(level, mu1, sigma1_sq, dist_levels.level(scale), sd), compute_den=False)
+            num += scale_num
+
+        value = num/self.vifp_den
+        if numpy.isnan(value):
+            return 1.0
+        else:
+            return value
+
+    """
+    Box-window SSIM, as ssim.ssim and the video metric 'ssim'
+    """
+    def ssim(self, dist):
+        return ssim.ssim_from_box_moments(self.ssim_box, ssim.box_moments(dist), (0.01 * self.peak)**2, (0.03 * self.peak)**2)
+
+    """
+    Gaussian-window SSIM, as ssim.ssim_exact; the reference maps are computed on first use
+    """
+    def ssim_exact(self, dist):
+        if self.ssim_mu1 is None:
+            self.ssim_mu1, self.ssim_sigma1_sq = moments.single_moments(self.ref, self.ssim_sd)
+        m = moments.cross_moments(self.ref, self.ssim_mu1, self.ssim_sigma1_sq, dist, self.ssim_sd)
+        return ssim.ssim_from_moments(m, (0.01 * self.peak)**2, (0.03 * self.peak)**2)
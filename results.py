@@ -0,0 +1,278 @@
+"""
+Video Quality Metrics
+Copyright (c) 2014 Alex Izvorski <aizvorski@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Per-frame results output and end-of-run aggregates
+
+Writers emit one record per frame as soon as it is scored, so output is streamed rather than collected:
+    'text'   Frame=12 RefFrame=11 VIFP=0.480636 SSIM=0.911159 (the historical measure.py format)
+    'jsonl'  {"frame": 12, "ref_frame": 11, "vifp": 0.480636, "ssim": 0.911159}, one object per line;
+             non-finite values (e.g. PSNR of identical frames) are written as null
+    'csv'    a header line, then frame,ref_frame,vifp,ssim rows
+    'npy'    a NumPy structured array with fields frame, ref_frame (int64) and one float64 field per
+             metric, readable with numpy.load; records are appended in chunks and the header is
+             rewritten with the final count at close, so the output must be a seekable file
+The ref_frame field is only present when frames are aligned (ref_frames=True).
+
+Summary accumulates the aggregates of every metric: mean, harmonic mean, percentiles, and the minimum and
+maximum with the frame they occur in.  It keeps each value as 8 bytes, which is small next to the frames.
+nan values (e.g. the temporal metrics of the first frame, which has no previous frame) are left out of the
+aggregates.
+"""
+
+import array
+import csv
+import json
+import math
+import sys
+import numpy
+import numpy.lib.format
+
+FORMATS = ('text', 'jsonl', 'csv', 'npy')
+
+PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+
+class ResultWriter(object):
+    def __init__(self, fh, metrics, ref_frames=False):
+        self.fh = fh
+        self.metrics = tuple(metrics)
+        self.ref_frames = ref_frames
+        self.own_fh = False
+        # Records to a pipe are flushed one by one so that consumers see them as they are produced
+        self.flush = fh is sys.stdout
+
+    def write(self, frame_num, values, ref_frame=None):
+        raise NotImplementedError
+
+    """
+    Write the summary (a Summary.result() dict) in the writer's format, if the format has room for it
+    Returns False if it does not.
+    """
+    def write_summary(self, summary):
+        return False
+
+    def close(self):
+        if self.own_fh:
+            self.fh.close()
+        else:
+            self.fh.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class TextWriter(ResultWriter):
+    def write(self, frame_num, values, ref_frame=None):
+        fields = " ".join("%s=%f" % (name.upper(), value) for name, value in zip(self.metrics, values))
+        if self.ref_frames:
+            self.fh.write("Frame=%d RefFrame=%d %s\n" % (frame_num, ref_frame, fields))
+        else:
+            self.fh.write("Frame=%d %s\n" % (frame_num, fields))
+        if self.flush:
+            self.fh.flush()
+
+    def write_summary(self, summary):
+        self.fh.write(format_summary(summary))
+        return True
+
+def _json_value(value):
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+class JsonlWriter(ResultWriter):
+    def write(self, frame_num, values, ref_frame=None):
+        record = {'frame': int(frame_num)}
+        if self.ref_frames:
+            record['ref_frame'] = int(ref_frame)
+        for name, value in zip(self.metrics, values):
+            record[name] = _json_value(value)
+        self.fh.write(json.dumps(record) + "\n")
+        if self.flush:
+            self.fh.flush()
+
+    def write_summary(self, summary):
+        self.fh.write(json.dumps({'summary': summary_json(summary)}) + "\n")
+        return True
+
+class CsvWriter(ResultWriter):
+    def __init__(self, fh, metrics, ref_frames=False):
+        ResultWriter.__init__(self, fh, metrics, ref_frames)
+        self.csv = csv.writer(fh, lineterminator="\n")
+        self.csv.writerow(['frame'] + (['ref_frame'] if ref_frames else []) + list(self.metrics))
+
+    def write(self, frame_num, values, ref_frame=None):
+        row = [int(frame_num)] + ([int(ref_frame)] if self.ref_frames else [])
+        self.csv.writerow(row + [repr(float(value)) for value in values])
+        if self.flush:
+            self.fh.flush()
+
+class NpyWriter(ResultWriter):
+    CHUNK_SIZE = 4096
+
+    def __init__(self, fh, metrics, ref_frames=False):
+        ResultWriter.__init__(self, fh, metrics, ref_frames)
+        if not fh.seekable():
+            raise ValueError("npy output must be written to a file")
+        fields = [('frame', '<i8')] + ([('ref_frame', '<i8')] if ref_frames else []) + [(name, '<f8') for name in self.metrics]
+        self.dtype = numpy.dtype(fields)
+        self.chunk = numpy.zeros(self.CHUNK_SIZE, dtype=self.dtype)
+        self.used = 0
+        self.count = 0
+        self.start = fh.tell()
+        fh.write(npy_header(self.dtype, 0))
+
+    def write(self, frame_num, values, ref_frame=None):
+        record = self.chunk[self.used]
+        record['frame'] = frame_num
+        if self.ref_frames:
+            record['ref_frame'] = ref_frame
+        for name, value in zip(self.metrics, values):
+            record[name] = value
+        self.used += 1
+        if self.used == self.CHUNK_SIZE:
+            self._write_chunk()
+
+    def _write_chunk(self):
+        self.fh.write(self.chunk[:self.used].tobytes())
+        self.count += self.used
+        self.used = 0
+
+    def close(self):
+        self._write_chunk()
+        end = self.fh.tell()
+        self.fh.seek(self.start)
+        self.fh.write(npy_header(self.dtype, self.count))
+        self.fh.seek(end)
+        ResultWriter.close(self)
+
+"""
+.npy version 1.0 header for a 1-D array of count records of dtype
+The header is padded to the length it would have for the largest possible count, so it can be rewritten in
+place once the final count is known.
+"""
+def npy_header(dtype, count):
+    def header(count):
+        return "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (numpy.lib.format.dtype_to_descr(dtype), count)
+    preamble = len(numpy.lib.format.MAGIC_PREFIX) + 4
+    # Magic, version, header length, header and a newline, aligned to 64 bytes
+    size = (preamble + len(header(2**63 - 1)) + 1 + 63) // 64 * 64
+    text = header(count)
+    text += " " * (size - preamble - len(text) - 1) + "\n"
+    return numpy.lib.format.magic(1, 0) + numpy.array(len(text), dtype='<u2').tobytes() + text.encode('latin1')
+
+WRITERS = {
+    'text': TextWriter,
+    'jsonl': JsonlWriter,
+    'csv': CsvWriter,
+    'npy': NpyWriter,
+}
+
+"""
+Writer for fmt to filename, or to stdout if filename is None or '-'
+"""
+def open_writer(fmt, filename, metrics, ref_frames=False):
+    if fmt not in WRITERS:
+        raise ValueError("Unknown output format %s, expected one of %s" % (fmt, ", ".join(FORMATS)))
+    if filename is None or filename == '-':
+        if fmt == 'npy':
+            raise ValueError("npy output must be written to a file")
+        return WRITERS[fmt](sys.stdout, metrics, ref_frames)
+    fh = open(filename, 'wb' if fmt == 'npy' else 'w')
+    try:
+        writer = WRITERS[fmt](fh, metrics, ref_frames)
+    except Exception:
+        fh.close()
+        raise
+    writer.own_fh = True
+    return writer
+
+class Summary(object):
+    def __init__(self, metrics, percentiles=PERCENTILES):
+        self.metrics = tuple(metrics)
+        self.percentiles = percentiles
+        self.frames = array.array('q')
+        self.values = [array.array('d') for _ in self.metrics]
+
+    def add(self, frame_num, values):
+        self.frames.append(int(frame_num))
+        for column, value in zip(self.values, values):
+            column.append(float(value))
+
+    """
+    {metric: {'count', 'mean', 'harmonic_mean', 'min', 'min_frame', 'max', 'max_frame', 'percentiles': {p: value}}}
+    The harmonic mean is nan unless every value is positive.  Merged shard results (see shard.py) also have
+    'pooled' for the metrics that can be pooled over frames.
+    """
+    def result(self):
+        frames = numpy.frombuffer(self.frames, dtype=numpy.int64) if len(self.frames) else numpy.zeros(0, dtype=numpy.int64)
+        summary = {}
+        for name, column in zip(self.metrics, self.values):
+            x = numpy.frombuffer(column, dtype=numpy.float64) if len(column) else numpy.zeros(0)
+            x_frames = frames
+            if numpy.isnan(x).any():
+                keep = ~numpy.isnan(x)
+                x, x_frames = x[keep], frames[keep]
+            if len(x) == 0:
+                summary[name] = {'count': 0}
+                continue
+            if numpy.all(x > 0):
+                harmonic_mean = len(x) / math.fsum(1.0 / x)
+            else:
+                harmonic_mean = float('nan')
+            i_min, i_max = int(numpy.argmin(x)), int(numpy.argmax(x))
+            summary[name] = {
+                'count': len(x),
+                'mean': math.fsum(x) / len(x),
+                'harmonic_mean': harmonic_mean,
+                'min': float(x[i_min]),
+                'min_frame': int(x_frames[i_min]),
+                'max': float(x[i_max]),
+                'max_frame': int(x_frames[i_max]),
+                'percentiles': dict((p, float(v)) for p, v in zip(self.percentiles, numpy.percentile(x, self.percentiles))),
+            }
+        return summary
+
+def format_summary(summary):
+    lines = []
+    for name, s in summary.items():
+        if s['count'] == 0:
+            continue
+        line = "Mean %s=%f HarmonicMean=%f Min=%f (Frame=%d) Max=%f (Frame=%d) %s" % (
+            name.upper(), s['mean'], s['harmonic_mean'], s['min'], s['min_frame'], s['max'], s['max_frame'],
+            " ".join("P%g=%f" % (p, v) for p, v in sorted(s['percentiles'].items())))
+        if 'pooled' in s:
+            line += " Pooled=%f" % (s['pooled'])
+        lines.append(line)
+    return "".join(line + "\n" for line in lines)
+
+"""
+summary with non-finite values as null and percentile keys as strings, for json.dumps
+"""
+def summary_json(summary):
+    out = {}
+    for name, s in summary.items():
+        s = dict(s)
+        for key in ('mean', 'harmonic_mean', 'min', 'max', 'pooled'):
+            if key in s:
+                s[key] = _json_value(s[key])
+        if 'percentiles' in s:
+            s['percentiles'] = dict(("%g" % p, _json_value(v)) for p, v in s['percentiles'].items())
+        out[name] = s
+    return out
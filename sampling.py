@@ -0,0 +1,124 @@
+"""
+Video Quality Metrics
+Copyright (c) 2014 Alex Izvorski <aizvorski@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Estimating the mean of per-frame metrics from a sample of frames
+
+The frames are split into strata (equal runs of frames, optionally cut at scene changes), a few random
+frames of every stratum are scored, and the sample is doubled until the confidence interval of the
+stratified mean of every metric is narrower than the requested tolerance, or every frame has been scored.
+
+Cite: Cochran, W. G., Sampling Techniques, 3rd ed. (1977), ch. 5 (stratified random sampling).
+"""
+
+import collections
+import numpy
+import scipy.stats
+
+import psnr
+
+Estimate = collections.namedtuple('Estimate', ['mean', 'low', 'high'])
+
+class SampleResult(object):
+    def __init__(self, metrics, estimates, scores, num_frames):
+        if num_frames < 1:
+            raise ValueError("A sample needs a population of at least one frame, got %d" % (num_frames))
+        self.metrics = metrics
+        self.estimates = estimates
+        # Per-frame values of every scored frame, frame number -> tuple of metric values
+        self.scores = scores
+        self.num_frames = num_frames
+
+    @property
+    def fraction(self):
+        return len(self.scores) / float(self.num_frames)
+
+"""
+Boundaries of uniform strata of about stratum_size frames, plus a boundary at every scene cut
+Returns a sorted list of stratum start frames, beginning with 0.
+"""
+def strata_starts(num_frames, stratum_size, scene_cuts=()):
+    starts = set(range(0, num_frames, max(1, stratum_size)))
+    starts.update(cut for cut in scene_cuts if 0 < cut < num_frames)
+    return sorted(starts)
+
+"""
+Frames that start a new scene: where the PSNR between consecutive thumbnails (see align.Thumbnails)
+drops below threshold dB
+"""
+def scene_cuts(thumbs, threshold=20.0):
+    return [i for i in range(1, len(thumbs)) if psnr.psnr(thumbs[i - 1], thumbs[i]) < threshold]
+
+"""
+Stratified mean of each metric and its confidence interval
+strata: list of (stratum size, per-frame values of the scored frames, shape (n, num_metrics)); every stratum
+  needs at least one scored frame
+"""
+def stratified_estimate(strata, num_metrics, confidence=0.95):
+    if not strata or any(len(values) == 0 for _, values in strata):
+        raise ValueError("Cannot estimate a mean without scored frames in every stratum")
+    total = float(sum(size for size, _ in strata))
+    mean = numpy.zeros(num_metrics)
+    var = numpy.zeros(num_metrics)
+    dof = 0
+    for size, values in strata:
+        values = numpy.asarray(values, dtype=numpy.float64)
+        n = values.shape[0]
+        weight = size / total
+        mean += weight * numpy.mean(values, axis=0)
+        if n > 1 and n < size:
+            # With finite population correction; a fully scored stratum contributes no error
+            var += weight**2 * numpy.var(values, axis=0, ddof=1) / n * (1 - n / float(size))
+            dof += n - 1
+    half_width = numpy.sqrt(var) * scipy.stats.t.ppf(0.5 + confidence / 2, max(dof, 1))
+    return [Estimate(m, m - h, m + h) for m, h in zip(mean, half_width)]
+
+"""
+Estimate the mean of every metric over frames 0 .. num_frames-1.
+score_frames: callable taking a list of frame numbers and returning an iterable of (frame number, tuple of
+  metric values), e.g. a partial application of video.score_video
+tolerance: maximum half width of the confidence interval, a number or a list with one per metric
+"""
+def sample_mean(score_frames, num_frames, metrics, tolerance, confidence=0.95, stratum_size=100,
+                scene_cut_frames=(), initial_per_stratum=2, seed=0):
+    rs = numpy.random.RandomState(seed)
+    tolerance = numpy.asarray(tolerance, dtype=numpy.float64).reshape(-1)
+    if len(tolerance) not in (1, len(metrics)):
+        raise ValueError("Expected one tolerance, or one per metric (%d), got %d" % (len(metrics), len(tolerance)))
+    tolerance = numpy.broadcast_to(tolerance, (len(metrics),))
+    if num_frames < 1:
+        raise ValueError("Cannot estimate the mean of %d frames" % (num_frames))
+
+    starts = strata_starts(num_frames, stratum_size, scene_cut_frames)
+    ends = starts[1:] + [num_frames]
+    # Frames of each stratum in random order; the first n of them are the sample of size n
+    orders = [start + rs.permutation(end - start) for start, end in zip(starts, ends)]
+
+    scores = {}
+    per_stratum = initial_per_stratum
+    while True:
+        todo = [int(frame) for order in orders for frame in order[:per_stratum] if frame not in scores]
+        for frame_num, values in score_frames(todo):
+            scores[frame_num] = tuple(values)
+
+        strata = [(len(order), [scores[frame] for frame in order[:per_stratum]]) for order in orders]
+        estimates = stratified_estimate(strata, len(metrics), confidence)
+        half_widths = numpy.array([(e.high - e.low) / 2 for e in estimates])
+        if numpy.all(half_widths <= tolerance) or len(scores) >= num_frames:
+            return SampleResult(metrics, estimates, scores, num_frames)
+        per_stratum *= 2
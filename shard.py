@@ -0,0 +1,283 @@
+from __future__ import print_function
+
+"""
+Video Quality Metrics
+Copyright (c) 2014 Alex Izvorski <aizvorski@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Scoring a long video in shards, on one machine or many, and merging the partial results
+
+The frames are split into contiguous ranges (plan_shards).  Each shard is scored by its own job
+(run_shard, or measure.py --shards N --shard I), which writes a partial result file holding the frame
+plan, the per-frame values and the sums of the terms of its frames (video.FRAME_TERMS), from which the
+pooled VIFP and PSNR of the whole video are computed.  merge checks that every shard of the plan is there
+and holds the frames it should.
+Sums are kept exactly, as the non-overlapping partials of Shewchuk's algorithm (as used by math.fsum),
+so merging gives bit for bit the values of a single run whatever the number of shards.
+
+run_local scores the shards in local processes and merges them, with no scheduler.  On a cluster, run
+one measure.py --shard job per shard, then merge their files:
+    python shard.py shard-*.json [--output-format jsonl] [--output FILE] [--summary FILE]
+"""
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import sys
+
+import instrument
+import psnr
+import results
+import video
+
+VERSION = 2
+
+class ExactSum(object):
+    """
+    partials: the partials of another ExactSum, to continue its sum
+    """
+    def __init__(self, partials=()):
+        self.partials = [float(p) for p in partials]
+
+    def add(self, x):
+        x = float(x)
+        partials = self.partials
+        i = 0
+        for y in partials:
+            if abs(x) < abs(y):
+                x, y = y, x
+            hi = x + y
+            lo = y - (hi - x)
+            if lo:
+                partials[i] = lo
+                i += 1
+            x = hi
+        partials[i:] = [x]
+
+    def merge(self, other):
+        for p in other.partials:
+            self.add(p)
+
+    def value(self):
+        return math.fsum(self.partials)
+
+"""
+Mergeable totals of the terms (video.FRAME_TERMS) of a set of frames
+"""
+class Totals(object):
+    def __init__(self, metrics, peak=255.0):
+        self.metrics = tuple(metrics)
+        self.peak = peak
+        self.count = 0
+        self.terms = dict((term, ExactSum()) for term in self._term_names())
+
+    def _term_names(self):
+        names = []
+        if 'vifp' in self.metrics:
+            names += ['vifp_num', 'vifp_den']
+        if 'psnr' in self.metrics:
+            names += ['psnr_mse']
+        return names
+
+    def add(self, terms):
+        self.count += 1
+        for term, value in terms.items():
+            self.terms[term].add(value)
+
+    def merge(self, other):
+        if other.metrics != self.metrics or other.peak != self.peak:
+            raise ValueError("Cannot merge totals of metrics %s (peak %g) into %s (peak %g)" % (
+                ",".join(other.metrics), other.peak, ",".join(self.metrics), self.peak))
+        self.count += other.count
+        for term in self.terms:
+            self.terms[term].merge(other.terms[term])
+
+    """
+    {metric: the metric of all frames pooled}, for the metrics that have terms
+    """
+    def result(self):
+        out = {}
+        if 'vifp' in self.metrics and self.count:
+            num, den = self.terms['vifp_num'].value(), self.terms['vifp_den'].value()
+            out['vifp'] = num / den if den else 1.0
+        if 'psnr' in self.metrics and self.count:
+            out['psnr'] = psnr.psnr_from_mse(self.terms['psnr_mse'].value() / self.count, self.peak)
+        return out
+
+    def to_json(self):
+        return {'metrics': list(self.metrics), 'peak': self.peak, 'count': self.count,
+                'terms': dict((term, s.partials) for term, s in self.terms.items())}
+
+    @classmethod
+    def from_json(cls, data):
+        totals = cls(data['metrics'], data['peak'])
+        totals.count = data['count']
+        for term, partials in data['terms'].items():
+            totals.terms[term] = ExactSum(partials)
+        return totals
+
+"""
+Split frame_indices (e.g. VideoPair.frame_indices()) into num_shards contiguous ranges of nearly equal length
+"""
+def plan_shards(frame_indices, num_shards):
+    if num_shards < 1:
+        raise ValueError("Need at least one shard")
+    n = len(frame_indices)
+    bounds = [n * i // num_shards for i in range(num_shards + 1)]
+    return [frame_indices[bounds[i]:bounds[i + 1]] for i in range(num_shards)]
+
+"""
+Score the frames of shard number `shard` of frame_indices (a range, e.g. VideoPair.frame_indices()) split into
+num_shards, and write its partial result to output
+The file is written under a temporary name and renamed once complete, so a finished file is never partial.
+"""
+def run_shard(ref_file, dist_file, width, height, fmt, frame_indices, num_shards, shard, metrics=video.DEFAULT_METRICS,
+              output=None):
+    metrics = tuple(metrics)
+    pair = video.VideoPair(ref_file, dist_file, width, height, fmt)
+    totals = Totals(metrics, pair.peak)
+    records = []
+    for frame_num in plan_shards(frame_indices, num_shards)[shard]:
+        with instrument.frame(frame_num):
+            ref_planes, dist_planes = pair.read(frame_num, frame_num)
+            terms = {}
+            values = video.score_frame(ref_planes[0], dist_planes[0], metrics, pair.peak, terms)
+        records.append([int(frame_num)] + [float(v) for v in values])
+        totals.add(terms)
+
+    partial = {'version': VERSION, 'shard': shard, 'num_shards': num_shards,
+               'frames': [frame_indices.start, frame_indices.stop, frame_indices.step],
+               'ref_file': ref_file, 'dist_file': dist_file, 'width': width, 'height': height, 'format': fmt,
+               'metrics': list(metrics), 'records': records, 'totals': totals.to_json()}
+    if output is not None:
+        tmp = "%s.tmp%d" % (output, os.getpid())
+        with open(tmp, 'w') as fh:
+            json.dump(partial, fh)
+        os.rename(tmp, output)
+    return partial
+
+def read_partial(filename):
+    with open(filename) as fh:
+        partial = json.load(fh)
+    if partial.get('version') != VERSION:
+        raise ValueError("%s is not a version %d shard result" % (filename, VERSION))
+    return partial
+
+class Merged(object):
+    def __init__(self, metrics, records, totals):
+        self.metrics = metrics
+        # [frame number, value of each metric], in frame order
+        self.records = records
+        self.totals = totals
+
+"""
+Combine the partial results of the shards (dicts from run_shard or read_partial) of one video pair
+Raises ValueError unless they are the shards of one plan, each exactly once, and hold the frames of the plan.
+"""
+def merge(partials):
+    if not partials:
+        raise ValueError("No shard results to merge")
+    first = partials[0]
+    key = lambda p: (p['ref_file'], p['dist_file'], p['width'], p['height'], p['format'], p['metrics'],
+                     p['num_shards'], p['frames'])
+    for partial in partials[1:]:
+        if key(partial) != key(first):
+            raise ValueError("Shard %d scored %s against %s (%s, %d shards), shard %d %s against %s (%s, %d shards)" % (
+                first['shard'], first['dist_file'], first['ref_file'], ",".join(first['metrics']), first['num_shards'],
+                partial['shard'], partial['dist_file'], partial['ref_file'], ",".join(partial['metrics']), partial['num_shards']))
+
+    num_shards = first['num_shards']
+    by_shard = {}
+    for partial in partials:
+        if partial['shard'] in by_shard:
+            raise ValueError("Shard %d was given more than once" % (partial['shard']))
+        by_shard[partial['shard']] = partial
+    missing = [i for i in range(num_shards) if i not in by_shard]
+    if missing:
+        raise ValueError("Missing %d of %d shards: %s" % (len(missing), num_shards, ",".join(str(i) for i in missing)))
+
+    plan = plan_shards(range(*first['frames']), num_shards)
+    totals = Totals(first['metrics'], first['totals']['peak'])
+    records = []
+    for i in range(num_shards):
+        partial = by_shard[i]
+        if [r[0] for r in partial['records']] != list(plan[i]):
+            raise ValueError("Shard %d does not hold the frames of its plan" % (i))
+        totals.merge(Totals.from_json(partial['totals']))
+        records.extend(partial['records'])
+    return Merged(tuple(first['metrics']), records, totals)
+
+def _run_shard_job(job):
+    return run_shard(*job)
+
+"""
+Score frame_indices (a range) in num_shards shards run by a pool of local processes (one per CPU by default),
+writing the partial results to workdir if given, and return the merged result
+"""
+def run_local(ref_file, dist_file, width, height, fmt, frame_indices, metrics=video.DEFAULT_METRICS,
+              num_shards=None, processes=None, workdir=None):
+    if num_shards is None:
+        num_shards = processes or multiprocessing.cpu_count()
+    jobs = []
+    for i in range(num_shards):
+        output = None if workdir is None else os.path.join(workdir, "shard-%04d.json" % (i))
+        jobs.append((ref_file, dist_file, width, height, fmt, frame_indices, num_shards, i, tuple(metrics), output))
+    pool = multiprocessing.Pool(processes)
+    try:
+        partials = pool.map(_run_shard_job, jobs, 1)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return merge(partials)
+
+"""
+Write a merged result with a results writer and the aggregates of every metric
+Returns the Summary.result() dict, with the pooled value of the shard totals added to the metrics that have one.
+"""
+def write_merged(merged, writer):
+    summary = results.Summary(merged.metrics)
+    for record in merged.records:
+        writer.write(record[0], record[1:])
+        summary.add(record[0], record[1:])
+    result = summary.result()
+    for name, pooled in merged.totals.result().items():
+        result[name]['pooled'] = pooled
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Merge the partial results of measure.py --shard jobs")
+    parser.add_argument("partials", nargs="+", metavar="SHARD_FILE")
+    parser.add_argument("--output-format", default="text", choices=results.FORMATS, help="per-frame output format (default: %(default)s)")
+    parser.add_argument("--output", metavar="FILE", help="write per-frame results to FILE instead of stdout")
+    parser.add_argument("--summary", metavar="FILE", help="also write the aggregates to FILE as JSON")
+    args = parser.parse_args()
+
+    try:
+        merged = merge([read_partial(filename) for filename in args.partials])
+        writer = results.open_writer(args.output_format, args.output, merged.metrics)
+    except ValueError as e:
+        parser.error(str(e))
+    result = write_merged(merged, writer)
+    if not writer.write_summary(result):
+        sys.stderr.write(results.format_summary(result))
+    writer.close()
+    if args.summary:
+        with open(args.summary, "w") as fh:
+            json.dump(results.summary_json(result), fh, indent=2)
@@ -17,7 +17,10 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import numpy
-from scipy.ndimage import gaussian_filter
+
+import instrument
+import moments
+from moments import local_moments
 
 from numpy.lib.stride_tricks import as_strided as ast
 
@@ -30,42 +33,132 @@ def block_view(A, block=(3, 3)):
     compatible with the shape of A."""
     # simple shape and strides computations may seem at first strange
     # unless one is able to recognize the 'tuple additions' involved ;-)
-    shape = (A.shape[0]/ block[0], A.shape[1]/ block[1])+ block
+    shape = (A.shape[0]// block[0], A.shape[1]// block[1])+ block
     strides = (block[0]* A.strides[0], block[1]* A.strides[1])+ A.strides
     return ast(A, shape= shape, strides= strides)
 
 
-def ssim(img1, img2, C1=0.01**2, C2=0.03**2):
+"""
+Summed-area table (integral image) over the last two axes, with a leading row and column of zeros,
+so that the sum of any window is four lookups regardless of the window size.
+"""
+def integral_image(img):
+    sat = numpy.zeros(img.shape[:-2] + (img.shape[-2] + 1, img.shape[-1] + 1))
+    numpy.cumsum(img, axis=-2, out=sat[..., 1:, 1:])
+    numpy.cumsum(sat[..., 1:, 1:], axis=-1, out=sat[..., 1:, 1:])
+    return sat
 
-    bimg1 = block_view(img1, (4,4))
-    bimg2 = block_view(img2, (4,4))
-    s1  = numpy.sum(bimg1, (-1, -2))
-    s2  = numpy.sum(bimg2, (-1, -2))
-    ss  = numpy.sum(bimg1*bimg1, (-1, -2)) + numpy.sum(bimg2*bimg2, (-1, -2))
-    s12 = numpy.sum(bimg1*bimg2, (-1, -2))
+"""
+Sums over all window x window boxes of the image an integral image was made from,
+with the top left corners of the boxes stride pixels apart
+"""
+def box_sums(sat, window, stride=1):
+    h = sat.shape[-2] - window
+    w = sat.shape[-1] - window
+    return (sat[..., window::stride, window::stride] - sat[..., :h:stride, window::stride]
+            - sat[..., window::stride, :w:stride] + sat[..., :h:stride, :w:stride])
 
-    vari = ss - s1*s1 - s2*s2
-    covar = s12 - s1*s2
+"""
+SSIM with uniform (box) windows, computed from integral images in O(1) per window for any window size.
+window=8, stride=1 is the sliding 8x8 window of the original SSIM paper; stride=window gives
+non-overlapping blocks.  Scores are close to (but not the same as) the Gaussian-window ssim_exact.
+"""
+def ssim(img1, img2, C1=0.01**2, C2=0.03**2, window=8, stride=1):
+    return ssim_from_box_moments(box_moments(img1, window, stride), box_moments(img2, window, stride), C1, C2, window, stride)
 
-    ssim_map =  (2*s1*s2 + C1) * (2*covar + C2) / ((s1*s1 + s2*s2 + C1) * (vari + C2))
+"""
+The parts of ssim() that depend on one image only: (mean, image - mean, box means of image - mean and of its square)
+Variance and covariance do not depend on the mean, so it is removed to keep the sums small and avoid
+cancellation in E[x^2] - E[x]^2; the means are added back to the local means.
+"""
+def box_moments(img, window=8, stride=1):
+    offset = numpy.mean(img, axis=(-2, -1), keepdims=True)
+    x = img - offset
+    n = float(window * window)
+    s = box_sums(integral_image(x), window, stride) / n
+    ss = box_sums(integral_image(x * x), window, stride) / n
+    return offset, x, s, ss
+
+"""
+ssim() from the box_moments() of both images, e.g. with those of a reference computed once
+"""
+def ssim_from_box_moments(box1, box2, C1=0.01**2, C2=0.03**2, window=8, stride=1):
+    offset1, x1, s1, s11 = box1
+    offset2, x2, s2, s22 = box2
+    s12 = box_sums(integral_image(x1 * x2), window, stride) / float(window * window)
+
+    sigma1_sq = s11 - s1 * s1
+    sigma2_sq = s22 - s2 * s2
+    sigma12 = s12 - s1 * s2
+    mu1 = s1 + offset1
+    mu2 = s2 + offset2
+
+    ssim_map = ((2 * mu1 * mu2 + C1) * (2 * sigma12 + C2)) / ((mu1 * mu1 + mu2 * mu2 + C1) * (sigma1_sq + sigma2_sq + C2))
     return numpy.mean(ssim_map)
 
 # FIXME there seems to be a problem with this code
 def ssim_exact(img1, img2, sd=1.5, C1=0.01**2, C2=0.03**2):
+    return ssim_from_moments(local_moments(img1, img2, sd), C1, C2)
 
-    mu1 = gaussian_filter(img1, sd)
-    mu2 = gaussian_filter(img2, sd)
-    mu1_sq = mu1 * mu1
-    mu2_sq = mu2 * mu2
-    mu1_mu2 = mu1 * mu2
-    sigma1_sq = gaussian_filter(img1 * img1, sd) - mu1_sq
-    sigma2_sq = gaussian_filter(img2 * img2, sd) - mu2_sq
-    sigma12 = gaussian_filter(img1 * img2, sd) - mu1_mu2
+"""
+ssim_exact of each pair of images of two (N, H, W) stacks, filtering several images per call
+(see moments.batch_slices).  Same values as ssim_exact() on every pair to rounding (about 1e-14 relative, as
+stacks of many images are filtered with matrix products, see filters.py).
+"""
+def ssim_exact_batch(img1, img2, sd=1.5, C1=0.01**2, C2=0.03**2, workspace=None):
+    if workspace is None:
+        workspace = moments.Workspace()
+    values = []
+    for chunk in moments.batch_slices(img1.shape):
+        ssim_map = ssim_map_from_moments(local_moments(img1[chunk], img2[chunk], sd, workspace), C1, C2)
+        values.append(numpy.mean(ssim_map.reshape(ssim_map.shape[:-2] + (-1,)), axis=-1))
+    return numpy.concatenate(values)
+
+"""
+Mean SSIM from precomputed local moments (see moments.py)
+For images with dynamic range L rather than 0-1, pass C1 and C2 multiplied by L**2.
+"""
+def ssim_from_moments(m, C1=0.01**2, C2=0.03**2):
+    return numpy.mean(ssim_map_from_moments(m, C1, C2))
+
+def ssim_map_from_moments(m, C1=0.01**2, C2=0.03**2):
+    mu1_mu2 = m.mu1 * m.mu2
 
-    ssim_num = ((2 * mu1_mu2 + C1) * (2 * sigma12 + C2))
+    ssim_num = ((2 * mu1_mu2 + C1) * (2 * m.sigma12 + C2))
 
-    ssim_den = ((mu1_sq + mu2_sq + C1) * (sigma1_sq + sigma2_sq + C2))
+    ssim_den = ((m.mu1 * m.mu1 + m.mu2 * m.mu2 + C1) * (m.sigma1_sq + m.sigma2_sq + C2))
 
     ssim_map = ssim_num / ssim_den
-    return numpy.mean(ssim_map)
+    return ssim_map
 
+"""
+Contrast-structure term of SSIM, the part of ssim_from_moments that does not depend on the means
+"""
+def cs_from_moments(m, C2=0.03**2):
+    return numpy.mean((2 * m.sigma12 + C2) / (m.sigma1_sq + m.sigma2_sq + C2))
+
+MSSSIM_WEIGHTS = (0.0448, 0.2856, 0.3001, 0.2363, 0.1333)
+
+"""
+Multi-scale SSIM
+Product of the contrast-structure terms of the first scales and the full SSIM of the last scale, each raised
+to its weight.  Scales are 2x2 box-filtered and decimated (pyramid method 'box'), as in the authors' Matlab
+code; the local statistics use the same Gaussian window as ssim_exact instead of an 11x11 valid window.
+Negative contrast-structure terms are clipped to 0, as fractional powers of them are undefined.
+cache: a moments.MomentsCache of (img1, img2), to share the pyramid levels and moments with other metrics
+
+Cite:
+Wang, Zhou, Eero P. Simoncelli, and Alan C. Bovik. "Multiscale structural similarity for image quality assessment." Signals, Systems and Computers, 2003. Vol. 2. IEEE, 2003.
+"""
+def msssim(img1, img2, sd=1.5, C1=0.01**2, C2=0.03**2, weights=MSSSIM_WEIGHTS, cache=None):
+    if cache is None:
+        cache = moments.MomentsCache(img1, img2)
+    value = 1.0
+    for scale, weight in enumerate(weights, 1):
+        with instrument.stage('msssim.scale', scale=scale):
+            m = cache.moments(scale, sd, 'box')
+            if scale < len(weights):
+                value *= max(cs_from_moments(m, C2), 0.0) ** weight
+            else:
+                value *= max(ssim_from_moments(m, C1, C2), 0.0) ** weight
+    return value
@@ -0,0 +1,201 @@
+"""
+Video Quality Metrics
+Copyright (c) 2014 Alex Izvorski <aizvorski@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Streaming raw video input from a pipe
+
+Reads rawvideo frames from a decoder subprocess (e.g. ffmpeg decoding H.264/HEVC/AV1) or from stdin, so
+compressed video can be scored without writing decoded YUV files to disk.  A reader thread fills a fixed
+ring of preallocated frame buffers while the caller scores the previous frames, so decoding and scoring
+overlap; once all buffers are full the reader waits, which bounds memory.
+
+Usage:
+    with StreamReader(ffmpeg_command('encode.mp4', 'yuv420p'), width, height) as frames:
+        for frame_num, (y, u, v) in frames:
+            ...
+
+The planes are views into a ring buffer; they are only valid until the next frame is requested.
+"""
+
+import collections
+import subprocess
+import sys
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy
+
+import instrument
+import yuv
+
+"""
+ffmpeg command line decoding filename to raw planar video on stdout
+"""
+def ffmpeg_command(filename, fmt='yuv420p', ffmpeg='ffmpeg'):
+    return [ffmpeg, '-v', 'error', '-nostdin', '-i', filename, '-f', 'rawvideo', '-pix_fmt', fmt, '-']
+
+"""
+Raised when the decoder cannot be started, or at the end of the stream when it exited with an error
+"""
+class DecoderError(RuntimeError):
+    pass
+
+class StreamReader(object):
+    """
+    source: a command (list of arguments) whose stdout is raw video, a raw video file name or binary file object,
+            or '-' for stdin
+    num_buffers: number of frames decoded ahead of the consumer
+    """
+    def __init__(self, source, width, height, fmt='yuv420p', num_buffers=4):
+        self.width = width
+        self.height = height
+        self.format = yuv.get_format(fmt)
+        self.frame_bytes = self.format.frame_bytes(width, height)
+        self.buffers = [numpy.empty(self.format.frame_samples(width, height), dtype=self.format.dtype)
+                        for _ in range(num_buffers + 1)]
+
+        self.process = None
+        self.own_fh = False
+        if source == '-':
+            self.fh = getattr(sys.stdin, 'buffer', sys.stdin)
+        elif isinstance(source, (list, tuple)):
+            self.command = source
+            try:
+                self.process = subprocess.Popen(source, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=self.frame_bytes)
+            except OSError as e:
+                raise DecoderError("Cannot run %s: %s" % (source[0], e.strerror or e))
+            self.fh = self.process.stdout
+            # The last lines of the decoder's messages, drained continuously so that it never blocks on them
+            self.stderr_lines = collections.deque(maxlen=20)
+            self.stderr_thread = threading.Thread(target=self._read_stderr)
+            self.stderr_thread.daemon = True
+            self.stderr_thread.start()
+        elif isinstance(source, str):
+            self.fh = open(source, 'rb')
+            self.own_fh = True
+        else:
+            self.fh = source
+
+        # Buffers cycle free -> filled (by the reader thread) -> in use by the consumer -> free
+        self.free = queue.Queue()
+        self.filled = queue.Queue()
+        for i in range(len(self.buffers)):
+            self.free.put(i)
+        self.in_use = None
+        self.stopped = False
+        self.error = None
+        self.thread = threading.Thread(target=self._read_frames)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read_frames(self):
+        try:
+            while not self.stopped:
+                i = self.free.get()
+                if i is None:
+                    break
+                view = memoryview(self.buffers[i]).cast('B')
+                got = _read_into(self.fh, view)
+                if got < self.frame_bytes:
+                    # End of stream; a trailing partial frame is ignored
+                    break
+                self.filled.put(i)
+            if self.process is not None and not self.stopped:
+                self._check_decoder()
+        except Exception as e:
+            self.error = e
+        self.filled.put(None)
+
+    def _read_stderr(self):
+        for line in self.process.stderr:
+            self.stderr_lines.append(line.decode('utf-8', 'replace').rstrip())
+
+    def _check_decoder(self):
+        returncode = self.process.wait()
+        if returncode != 0:
+            self.stderr_thread.join()
+            raise DecoderError("%s exited with status %d%s" % (
+                " ".join(self.command), returncode, "".join("\n  " + line for line in self.stderr_lines)))
+
+    def __iter__(self):
+        frame_num = 0
+        while True:
+            if self.in_use is not None:
+                self.free.put(self.in_use)
+                self.in_use = None
+            with instrument.stage('read'):
+                i = self.filled.get()
+            if i is None:
+                self.filled.put(None)
+                if self.error is not None:
+                    raise self.error
+                return
+            self.in_use = i
+            yield frame_num, yuv.split_planes(self.buffers[i], self.width, self.height, self.format)
+            frame_num += 1
+
+    def close(self):
+        self.stopped = True
+        self.free.put(None)
+        if self.process is not None:
+            # The reader thread sees end of stream once the decoder is gone
+            self.process.terminate()
+            self.thread.join()
+            self.process.stdout.close()
+            self.process.wait()
+            self.stderr_thread.join()
+            self.process.stderr.close()
+        else:
+            # Don't wait for a read from a file or stdin that may never return; the thread is a daemon
+            self.thread.join(1.0)
+            if self.own_fh and not self.thread.is_alive():
+                self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.mov', '.avi', '.webm', '.ts', '.ivf', '.y4m', '.264', '.h264', '.265', '.hevc', '.obu')
+
+"""
+True for inputs that have to go through a decoder (or stdin) rather than being memory mapped
+"""
+def is_stream(filename):
+    return filename == '-' or filename.lower().endswith(VIDEO_EXTENSIONS)
+
+"""
+StreamReader for a compressed video (through ffmpeg), stdin ('-') or a raw .yuv file (read sequentially)
+"""
+def open_video(filename, width, height, fmt='yuv420p', num_buffers=4):
+    if filename != '-' and is_stream(filename):
+        return StreamReader(ffmpeg_command(filename, fmt), width, height, fmt, num_buffers)
+    return StreamReader(filename, width, height, fmt, num_buffers)
+
+def _read_into(fh, view):
+    got = 0
+    while got < len(view):
+        n = fh.readinto(view[got:])
+        if not n:
+            break
+        got += n
+    return got
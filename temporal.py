@@ -0,0 +1,128 @@
+"""
+Video Quality Metrics
+Copyright (c) 2014 Alex Izvorski <aizvorski@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Temporal metrics over a sequence of frames
+
+TemporalScorer is fed the frames of a video pair in order and, for each frame, returns:
+    tssim        frame-difference SSIM: SSIM (Gaussian window, as ssim_exact) between the temporal differences
+                 ref[t] - ref[t-1] and dist[t] - dist[t-1], which catches flicker, jerkiness and temporal noise
+                 that per-frame metrics miss; nan for the first frame
+    ti           temporal information of the reference (ITU-T P.910): standard deviation of the frame
+                 difference, in sample units
+    window_ssim  sliding-window pooling of the last `window` frames: mean of ssim * tssim (ssim alone for
+                 the first frame), weighted by 1 + TI (TI in 8-bit units), so that distortions in moving
+                 content count more while static frames still count.  ssim is the frame's SSIM column
+                 (ssim.ssim, box window), passed in when it was already scored.
+
+Only the float planes and local means of the previous frame are kept.  As Gaussian filtering is linear, the
+local means of the differences are the differences of the local means, so each frame filters its two means
+and the three second-order maps of the differences, instead of five maps for the frame and five for the
+differences.  With --step, differences are between consecutive scored frames.
+
+Cite: Pinson, M. H., and S. Wolf. "A new standardized method for objectively measuring video quality." IEEE Transactions on Broadcasting 50.3 (2004): 312-322.
+"""
+
+import collections
+import math
+import numpy
+
+import instrument
+import moments
+import ssim
+from filters import gaussian_filter
+
+TemporalScores = collections.namedtuple('TemporalScores', ['tssim', 'ti', 'window_ssim'])
+
+# Per-frame values added to a video's metrics by measure.py --temporal
+TEMPORAL_METRICS = ('tssim', 'ti', 'window_ssim')
+
+class TemporalScorer(object):
+    def __init__(self, window=8, peak=255.0, sd=1.5):
+        self.window = window
+        self.peak = peak
+        self.sd = sd
+        self.C1 = (0.01 * peak)**2
+        self.C2 = (0.03 * peak)**2
+        # Float copies of the previous ref and dist planes, stacked, and their local means
+        self.prev = None
+        self.prev_means = None
+        # Frame differences and their second-order maps, reused from frame to frame
+        self.workspace = moments.Workspace()
+        # (weight, pooled score) of the last `window` frames
+        self.scores = collections.deque(maxlen=window)
+
+    """
+    Scores of the next frame (ref, dist: planes in 0-peak, integer or float)
+    ssim_value: the frame's ssim.ssim with constants scaled to peak (video.FRAME_METRICS['ssim']), if already
+    computed; otherwise it is computed here
+    """
+    def add(self, ref, dist, ssim_value=None):
+        if ssim_value is None:
+            with instrument.stage('temporal.ssim'):
+                ssim_value = ssim.ssim(numpy.asarray(ref, dtype=numpy.float64), numpy.asarray(dist, dtype=numpy.float64),
+                                       self.C1, self.C2)
+
+        tssim = ti = float('nan')
+        score = ssim_value
+        weight = 1.0
+        shape = (2,) + ref.shape
+        if self.prev is None or self.prev.shape != shape:
+            self.prev = None
+            frames = numpy.empty(shape, dtype=numpy.float64)
+        else:
+            frames = self.prev
+            with instrument.stage('temporal.tssim'):
+                diff = self.workspace.buffer('diff', shape, numpy.float64)
+                numpy.subtract(ref, frames[0], out=diff[0])
+                numpy.subtract(dist, frames[1], out=diff[1])
+                ti = float(numpy.std(diff[0]))
+
+        # The previous planes are no longer needed once the differences are taken
+        frames[0] = ref
+        frames[1] = dist
+        with instrument.stage('temporal.means'):
+            means = gaussian_filter(frames, (0, self.sd, self.sd))
+
+        if self.prev is not None:
+            with instrument.stage('temporal.tssim'):
+                stack = self.workspace.buffer('stack', (3,) + ref.shape, numpy.float64)
+                numpy.multiply(diff[0], diff[0], out=stack[0])
+                numpy.multiply(diff[1], diff[1], out=stack[1])
+                numpy.multiply(diff[0], diff[1], out=stack[2])
+                maps = gaussian_filter(stack, (0, self.sd, self.sd), output=stack)
+                mu1, mu2 = means - self.prev_means
+                maps[0] -= mu1 * mu1
+                maps[1] -= mu2 * mu2
+                maps[2] -= mu1 * mu2
+                diff_moments = moments.Moments(mu1, mu2, maps[0], maps[1], maps[2])
+                tssim = float(numpy.mean(ssim.ssim_map_from_moments(diff_moments, self.C1, self.C2)))
+            score = ssim_value * tssim
+            weight = 1.0 + ti * 255.0 / self.peak
+
+        self.prev = frames
+        self.prev_means = means
+
+        self.scores.append((weight, score))
+        window_ssim = math.fsum(w * s for w, s in self.scores) / math.fsum(w for w, _ in self.scores)
+        return TemporalScores(tssim, ti, window_ssim)
+
+    def reset(self):
+        self.prev = None
+        self.prev_means = None
+        self.scores.clear()
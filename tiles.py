@@ -0,0 +1,143 @@
+"""
+Video Quality Metrics
+Copyright (c) 2014 Alex Izvorski <aizvorski@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Tiled evaluation of VIFP, SSIM and RECO for very large frames (4K/8K) with bounded memory
+
+Each frame is processed in tile_size x tile_size tiles.  Every tile is filtered together with a halo as wide
+as the filter kernel's radius (or the image border, where the full-frame filter sees the same reflected
+boundary), and only the tile's interior is kept, so the per-pixel maps are exactly the full-frame ones.
+Only the partial sums (VIFP numerator/denominator, SSIM map sum, ECO sum) are kept per tile; the totals
+equal the full-frame results up to the order of floating point summation (~1e-15 relative).
+
+Peak memory is a few float arrays of (tile_size + 2 * halo)^2 per thread instead of the whole frame; the
+VIFP pyramid levels (1/4 of the frame and smaller) are the only whole-frame arrays.  Tiles can be
+processed in several threads.
+"""
+
+import concurrent.futures
+import numpy
+
+import filters
+import moments
+import pyramid
+import vifp
+import ssim
+from reco import kernel_params, kernel_size, lg_responses, eco_map
+
+"""
+Radius of scipy.ndimage.gaussian_filter's kernel (default truncate=4.0)
+"""
+def gaussian_radius(sd, truncate=4.0):
+    return int(truncate * sd + 0.5)
+
+def tiles(shape, tile_size):
+    h, w = shape[-2:]
+    return [(y0, min(y0 + tile_size, h), x0, min(x0 + tile_size, w))
+            for y0 in range(0, h, tile_size) for x0 in range(0, w, tile_size)]
+
+"""
+Slices of the tile plus halo within the image, and of the tile within that region
+"""
+def tile_region(shape, tile, halo):
+    h, w = shape[-2:]
+    y0, y1, x0, x1 = tile
+    ry0, ry1 = max(0, y0 - halo), min(h, y1 + halo)
+    rx0, rx1 = max(0, x0 - halo), min(w, x1 + halo)
+    region = (Ellipsis, slice(ry0, ry1), slice(rx0, rx1))
+    interior = (Ellipsis, slice(y0 - ry0, y1 - ry0), slice(x0 - rx0, x1 - rx0))
+    return region, interior
+
+def map_tiles(func, shape, tile_size, threads=1):
+    all_tiles = tiles(shape, tile_size)
+    if threads == 1:
+        return [func(tile) for tile in all_tiles]
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        return list(pool.map(func, all_tiles))
+
+"""
+filters.gaussian_filter(img, sd)[::2, ::2], tile by tile
+"""
+def downsample(img, sd, tile_size=512, threads=1):
+    tile_size += tile_size % 2  # tiles start on even rows and columns, like the decimation
+    halo = gaussian_radius(sd)
+    sigma = (0,) * (img.ndim - 2) + (sd, sd)
+    out = numpy.empty(img.shape[:-2] + ((img.shape[-2] + 1) // 2, (img.shape[-1] + 1) // 2), dtype=img.dtype)
+
+    def process(tile):
+        region, interior = tile_region(img.shape, tile, halo)
+        blurred = filters.gaussian_filter(img[region], sigma)[interior][..., ::2, ::2]
+        y0, x0 = tile[0] // 2, tile[2] // 2
+        out[..., y0:y0 + blurred.shape[-2], x0:x0 + blurred.shape[-1]] = blurred
+
+    map_tiles(process, img.shape, tile_size, threads)
+    return out
+
+def tile_moments(img1, img2, sd, tile, halo):
+    region, interior = tile_region(img1.shape, tile, halo)
+    m = moments.local_moments(img1[region], img2[region], sd)
+    return moments.Moments(*[x[interior] for x in m])
+
+def vifp_mscale(ref, dist, tile_size=512, threads=1):
+    num = 0.0
+    den = 0.0
+    for scale in range(1, 5):
+        sd = pyramid.vifp_sd(scale)
+
+        if (scale > 1):
+            ref = downsample(ref, sd, tile_size, threads)
+            dist = downsample(dist, sd, tile_size, threads)
+
+        halo = gaussian_radius(sd)
+        terms = map_tiles(lambda tile: vifp.vifp_terms(tile_moments(ref, dist, sd, tile, halo)), ref.shape, tile_size, threads)
+        for tile_num, tile_den in terms:
+            num += tile_num
+            den += tile_den
+
+    value = num/den
+
+    if numpy.isnan(value):
+        return 1.0
+    else:
+        return value
+
+def ssim_exact(img1, img2, sd=1.5, C1=0.01**2, C2=0.03**2, tile_size=512, threads=1):
+    halo = gaussian_radius(sd)
+    sums = map_tiles(lambda tile: numpy.sum(ssim.ssim_map_from_moments(tile_moments(img1, img2, sd, tile, halo), C1, C2), dtype=numpy.float64),
+                     img1.shape, tile_size, threads)
+    return numpy.sum(sums) / (img1.shape[-2] * img1.shape[-1])
+
+def eco(img, sigma=None, tile_size=512, threads=1):
+    if sigma is None:
+        size, sigma = kernel_params(img.shape)
+    else:
+        size = kernel_size(sigma)
+    halo = size // 2
+
+    def process(tile):
+        region, interior = tile_region(img.shape, tile, halo)
+        y10, y30 = lg_responses(img[region], size, sigma)
+        return numpy.sum(eco_map(y10[interior], y30[interior]))
+
+    return numpy.sum(map_tiles(process, img.shape, tile_size, threads))
+
+def reco(img1, img2, sigma=None, tile_size=512, threads=1):
+    if sigma is None:
+        _, sigma = kernel_params(img1.shape)
+    C = 1 # same as reco.reco
+    return (eco(img2, sigma, tile_size, threads) + C) / (eco(img1, sigma, tile_size, threads) + C)
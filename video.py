@@ -0,0 +1,283 @@
+"""
+Video Quality Metrics
+Copyright (c) 2014 Alex Izvorski <aizvorski@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Frame-by-frame scoring of a pair of raw YUV videos
+
+Frames are scored either serially or in a process pool.  Only frame numbers are sent to the worker
+processes; each worker opens its own memory map of both files, so pixel data is shared through the
+OS page cache instead of being pickled.  Results always come back in frame order, and each worker
+runs exactly the same score_frame() as the serial path, so the output does not depend on the number
+of workers.
+"""
+
+import multiprocessing
+import numpy
+
+import vifp
+import ssim
+import psnr
+import yuv
+import reference
+import instrument
+import moments
+import temporal
+
+# Scratch buffers of VIFP, reused from frame to frame (each worker process has its own)
+_vifp_workspace = moments.Workspace()
+
+"""
+Per-frame metrics on float planes in their natural range 0-peak (0-255 for 8-bit samples)
+SSIM and PSNR get their constants scaled to peak instead of dividing the planes by it.
+"""
+FRAME_METRICS = {
+    'vifp': lambda ref, dist, peak: vifp.vifp_mscale(ref, dist, workspace=_vifp_workspace),
+    'ssim': lambda ref, dist, peak: ssim.ssim(ref, dist, (0.01 * peak)**2, (0.03 * peak)**2),
+    'msssim': lambda ref, dist, peak: ssim.msssim(ref, dist, C1=(0.01 * peak)**2, C2=(0.03 * peak)**2),
+    'psnr': lambda ref, dist, peak: psnr.psnr(ref, dist, pixel_max=peak),
+}
+
+def _vifp_terms(ref, dist, peak):
+    num, den = vifp.vifp_mscale_terms(ref, dist, workspace=_vifp_workspace)
+    value = num / den
+    return (1.0 if numpy.isnan(value) else value), {'vifp_num': num, 'vifp_den': den}
+
+def _psnr_terms(ref, dist, peak):
+    mse = psnr.mse(ref, dist)
+    return psnr.psnr_from_mse(mse, peak), {'psnr_mse': mse}
+
+"""
+Metrics whose frames can also be pooled into one value by summing their terms (see shard.py): the same value
+as FRAME_METRICS and a dict of the frame's terms
+    'vifp'  the VIF numerator and denominator (pooled VIFP = sum(num) / sum(den))
+    'psnr'  the MSE (pooled PSNR = PSNR of the mean MSE)
+"""
+FRAME_TERMS = {
+    'vifp': _vifp_terms,
+    'psnr': _psnr_terms,
+}
+
+DEFAULT_METRICS = ('vifp', 'ssim')
+
+PLANES = ('y', 'u', 'v')
+
+# Weights of Y, U and V when combining per-plane scores, as commonly used for PSNR-YUV
+PLANE_WEIGHTS = (6, 1, 1)
+
+# Float copies of the planes being scored, converted once per frame and shared by all metrics
+_float_planes = moments.Workspace()
+
+"""
+plane converted to float64 in a buffer reused across frames; only valid until the next frame is scored
+"""
+def float_plane(plane, name):
+    out = _float_planes.buffer(name, plane.shape, numpy.float64)
+    out[...] = plane
+    return out
+
+"""
+Metric values of one plane pair (integer or float samples in 0-peak)
+terms: a dict to fill with the terms of the metrics in FRAME_TERMS
+"""
+def score_frame(ref, dist, metrics=DEFAULT_METRICS, peak=255.0, terms=None):
+    with instrument.stage('convert'):
+        ref = float_plane(ref, 'ref')
+        dist = float_plane(dist, 'dist')
+    values = []
+    for name in metrics:
+        with instrument.stage(name):
+            if terms is not None and name in FRAME_TERMS:
+                value, frame_terms = FRAME_TERMS[name](ref, dist, peak)
+                terms.update(frame_terms)
+                values.append(value)
+            else:
+                values.append(FRAME_METRICS[name](ref, dist, peak))
+    return tuple(values)
+
+"""
+Names of the values returned by score_planes: metric_y, metric_u, metric_v and the weighted metric_yuv
+for each metric
+"""
+def plane_metric_names(metrics):
+    return tuple("%s_%s" % (name, plane) for name in metrics for plane in PLANES + ('yuv',))
+
+def combine_planes(values, weights=PLANE_WEIGHTS):
+    return sum(w * v for w, v in zip(weights, values)) / float(sum(weights))
+
+"""
+Metric values of each of the Y, U, V plane pairs at their native (subsampled) resolution, and their
+weighted combination, in the order of plane_metric_names(metrics)
+"""
+def score_planes(ref_planes, dist_planes, metrics=DEFAULT_METRICS, peak=255.0, weights=PLANE_WEIGHTS):
+    per_plane = [score_frame(ref, dist, metrics, peak) for ref, dist in zip(ref_planes, dist_planes)]
+    values = []
+    for i in range(len(metrics)):
+        plane_values = [scores[i] for scores in per_plane]
+        values.extend(plane_values)
+        values.append(combine_planes(plane_values, weights))
+    return tuple(values)
+
+"""
+The luma value of metric name among the values of score_frame (planes='y') or score_planes (planes='yuv'),
+or None if it was not scored
+"""
+def luma_value(values, metrics, name, planes='y'):
+    if name not in metrics:
+        return None
+    i = list(metrics).index(name)
+    return values[i * (len(PLANES) + 1)] if planes == 'yuv' else values[i]
+
+class VideoPair(object):
+    def __init__(self, ref_file, dist_file, width, height, fmt='yuv420p'):
+        self.ref = yuv.YuvReader(ref_file, width, height, fmt)
+        self.dist = yuv.YuvReader(dist_file, width, height, fmt)
+        self.peak = float(self.ref.format.max_value)
+        # Planes of the frame being scored, copied out of the memory maps
+        self.buffers = moments.Workspace()
+
+    def __len__(self):
+        return min(len(self.ref), len(self.dist))
+
+    def frame_indices(self, start=0, count=None, step=1):
+        return range(start, len(self), step)[:count]
+
+    """
+    (y, u, v) planes of ref frame ref_num and dist frame dist_num, in buffers reused across frames
+    The planes are copied out of the memory maps, so that the disk reads happen (and are timed) here.
+    """
+    def read(self, ref_num, dist_num):
+        with instrument.stage('read'):
+            return self._copy(self.ref.frame(ref_num), 'ref'), self._copy(self.dist.frame(dist_num), 'dist')
+
+    def _copy(self, planes, name):
+        out = []
+        for i, plane in enumerate(planes):
+            buf = self.buffers.buffer((name, i), plane.shape, plane.dtype)
+            buf[...] = plane
+            out.append(buf)
+        return out
+
+    """
+    frame_num is a frame number, or a (ref frame, dist frame) pair from an alignment map (see align.py)
+    planes: 'y' to score luma only, 'yuv' for every plane (see score_planes)
+    temporal: a temporal.TemporalScorer fed the luma planes, whose TEMPORAL_METRICS values are appended; the
+    frames must then be scored in order
+    """
+    def score(self, frame_num, metrics=DEFAULT_METRICS, planes='y', temporal=None):
+        if isinstance(frame_num, tuple):
+            ref_num, dist_num = frame_num
+        else:
+            ref_num = dist_num = frame_num
+        with instrument.frame(dist_num):
+            ref_planes, dist_planes = self.read(ref_num, dist_num)
+            if planes == 'yuv':
+                values = score_planes(ref_planes, dist_planes, metrics, self.peak)
+            else:
+                values = score_frame(ref_planes[0], dist_planes[0], metrics, self.peak)
+            if temporal is not None:
+                values += tuple(temporal.add(ref_planes[0], dist_planes[0], luma_value(values, metrics, 'ssim', planes)))
+            return values
+
+# State of a worker process, set up once by _init_worker
+_worker = {}
+
+def _init_worker(ref_file, dist_file, width, height, fmt, metrics, planes):
+    _worker['pair'] = VideoPair(ref_file, dist_file, width, height, fmt)
+    _worker['metrics'] = metrics
+    _worker['planes'] = planes
+
+def _score_worker(frame_num):
+    return frame_num, _worker['pair'].score(frame_num, _worker['metrics'], _worker['planes'])
+
+"""
+Score the given frames, yielding (frame number, metric values) in the order of frame_indices.
+frame_indices may also hold (ref frame, dist frame) pairs, which are yielded in place of the frame number.
+workers=1 scores in this process; workers=None uses one process per CPU.
+planes='yuv' scores every plane, see score_planes.
+temporal_window: also compute temporal.TEMPORAL_METRICS over a sliding window of that many frames (workers=1 only,
+as they depend on the previous frames).
+"""
+def score_video(ref_file, dist_file, width, height, fmt='yuv420p', frame_indices=None,
+                metrics=DEFAULT_METRICS, workers=1, chunksize=1, planes='y', temporal_window=None):
+    metrics = tuple(metrics)
+    if temporal_window is not None and workers != 1:
+        raise ValueError("Temporal metrics need the frames in order, use workers=1")
+    if frame_indices is None:
+        frame_indices = VideoPair(ref_file, dist_file, width, height, fmt).frame_indices()
+
+    if workers == 1:
+        pair = VideoPair(ref_file, dist_file, width, height, fmt)
+        scorer = None
+        if temporal_window is not None:
+            scorer = temporal.TemporalScorer(temporal_window, pair.peak)
+        for frame_num in frame_indices:
+            yield frame_num, pair.score(frame_num, metrics, planes, scorer)
+        return
+
+    pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                initargs=(ref_file, dist_file, width, height, fmt, metrics, planes))
+    try:
+        for result in pool.imap(_score_worker, frame_indices, chunksize):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+# Metrics of score_encodes
+ENCODE_METRICS = ('vifp', 'ssim', 'psnr')
+
+"""
+Score several encodes of the same reference (e.g. a bitrate ladder) frame by frame.
+The reference-side features of each frame are computed once and shared by all encodes; the values are the
+same as those of score_video.
+Yields (frame number, [metric values for each encode]).
+"""
+def score_encodes(ref_file, dist_files, width, height, fmt='yuv420p', frame_indices=None, metrics=DEFAULT_METRICS):
+    for name in metrics:
+        if name not in ENCODE_METRICS:
+            raise ValueError("Unknown metric %s for several encodes, expected one of %s" % (name, ", ".join(ENCODE_METRICS)))
+    ref_reader = yuv.YuvReader(ref_file, width, height, fmt)
+    dist_readers = [yuv.YuvReader(dist_file, width, height, fmt) for dist_file in dist_files]
+    num_frames = min([len(ref_reader)] + [len(reader) for reader in dist_readers])
+    if frame_indices is None:
+        frame_indices = range(num_frames)
+    peak = float(ref_reader.format.max_value)
+
+    for frame_num in frame_indices:
+        with instrument.frame(frame_num):
+            ref, _, _ = ref_reader.frame(frame_num)
+            with instrument.stage('reference'):
+                ref = ref.astype(float)
+                features = reference.ReferenceFeatures(ref, peak)
+            values = []
+            for reader in dist_readers:
+                dist, _, _ = reader.frame(frame_num)
+                with instrument.stage('convert'):
+                    dist = float_plane(dist, 'dist')
+                encode_values = []
+                for name in metrics:
+                    with instrument.stage(name):
+                        if name == 'vifp':
+                            encode_values.append(features.vifp(dist))
+                        elif name == 'ssim':
+                            encode_values.append(features.ssim(dist))
+                        else:
+                            encode_values.append(psnr.psnr(ref, dist, pixel_max=peak))
+                values.append(tuple(encode_values))
+        yield frame_num, values
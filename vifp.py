@@ -59,55 +59,21 @@ Email comments and bug reports to hamid.sheikh@ieee.org
 
 
 import numpy
-import scipy.signal
-import scipy.ndimage
 
-def vifp_mscale(ref, dist):
-    sigma_nsq=2
-    eps = 1e-10
+import instrument
+import moments
+import pyramid
 
-    num = 0.0
-    den = 0.0
-    for scale in range(1, 5):
-       
-        N = 2**(4-scale+1) + 1
-        sd = N/5.0
-
-        if (scale > 1):
-            ref = scipy.ndimage.gaussian_filter(ref, sd)
-            dist = scipy.ndimage.gaussian_filter(dist, sd)
-            ref = ref[::2, ::2]
-            dist = dist[::2, ::2]
-                
-        mu1 = scipy.ndimage.gaussian_filter(ref, sd)
-        mu2 = scipy.ndimage.gaussian_filter(dist, sd)
-        mu1_sq = mu1 * mu1
-        mu2_sq = mu2 * mu2
-        mu1_mu2 = mu1 * mu2
-        sigma1_sq = scipy.ndimage.gaussian_filter(ref * ref, sd) - mu1_sq
-        sigma2_sq = scipy.ndimage.gaussian_filter(dist * dist, sd) - mu2_sq
-        sigma12 = scipy.ndimage.gaussian_filter(ref * dist, sd) - mu1_mu2
-        
-        sigma1_sq[sigma1_sq<0] = 0
-        sigma2_sq[sigma2_sq<0] = 0
-        
-        g = sigma12 / (sigma1_sq + eps)
-        sv_sq = sigma2_sq - g * sigma12
-        
-        g[sigma1_sq<eps] = 0
-        sv_sq[sigma1_sq<eps] = sigma2_sq[sigma1_sq<eps]
-        sigma1_sq[sigma1_sq<eps] = 0
-        
-        g[sigma2_sq<eps] = 0
-        sv_sq[sigma2_sq<eps] = 0
-        
-        sv_sq[g<0] = sigma2_sq[g<0]
-        g[g<0] = 0
-        sv_sq[sv_sq<=eps] = eps
-        
-        num += numpy.sum(numpy.log10(1 + g * g * sigma1_sq / (sv_sq + sigma_nsq)))
-        den += numpy.sum(numpy.log10(1 + sigma1_sq / sigma_nsq))
-        
+"""
+cache: a moments.MomentsCache of (ref, dist), to share the pyramid levels and moments with other metrics
+dtype: compute in this floating point type, e.g. numpy.float32 (default: the type of the inputs).
+  float32 halves memory traffic; on 8-bit content the result differs from the float64 one by
+  less than 1e-5 (relative error typically 1e-6).
+workspace: a moments.Workspace whose scratch buffers are reused across calls of the same frame size,
+  so that scoring a video does not allocate new full-frame temporaries for every frame.
+"""
+def vifp_mscale(ref, dist, cache=None, dtype=None, workspace=None):
+    num, den = vifp_mscale_terms(ref, dist, cache, dtype, workspace)
     vifp = num/den
 
     if numpy.isnan(vifp):
@@ -115,3 +81,133 @@ def vifp_mscale(ref, dist):
     else:
         return vifp
 
+"""
+Numerator and denominator of vifp_mscale, summed over the scales
+The terms of several frames can be summed to pool them into one VIFP (see shard.py).
+"""
+def vifp_mscale_terms(ref, dist, cache=None, dtype=None, workspace=None):
+    if cache is None:
+        if dtype is not None:
+            ref = numpy.asarray(ref, dtype=dtype)
+            dist = numpy.asarray(dist, dtype=dtype)
+        cache = moments.MomentsCache(ref, dist, workspace)
+    if workspace is None:
+        workspace = cache.workspace
+
+    num = 0.0
+    den = 0.0
+    for scale in range(1, 5):
+        sd = pyramid.vifp_sd(scale)
+        with instrument.stage('vifp.scale', scale=scale):
+            scale_num, scale_den = vifp_terms(cache.moments(scale, sd), workspace=workspace)
+        num += scale_num
+        den += scale_den
+    return num, den
+
+"""
+vifp_mscale of each pair of images of two (N, H, W) stacks, filtering several images per call
+(see moments.batch_slices).  Same values as vifp_mscale() on every pair to rounding (about 1e-13 relative, as
+stacks of many images are filtered with matrix products, see filters.py).
+"""
+def vifp_mscale_batch(ref, dist, dtype=None, workspace=None):
+    if dtype is not None:
+        ref = numpy.asarray(ref, dtype=dtype)
+        dist = numpy.asarray(dist, dtype=dtype)
+    if workspace is None:
+        workspace = moments.Workspace()
+
+    values = []
+    for chunk in moments.batch_slices(ref.shape):
+        cache = moments.MomentsCache(ref[chunk], dist[chunk], workspace)
+        num = 0.0
+        den = 0.0
+        for scale in range(1, 5):
+            sd = pyramid.vifp_sd(scale)
+            with instrument.stage('vifp.scale', scale=scale):
+                scale_num, scale_den = vifp_terms(cache.moments(scale, sd), workspace=workspace, per_image=True)
+            num += scale_num
+            den += scale_den
+        values.append(num/den)
+
+    vifp = numpy.concatenate(values)
+    vifp[numpy.isnan(vifp)] = 1.0
+    return vifp
+
+"""
+VIF denominator term at one scale, from the local variance of the reference alone
+Same value as the den returned by vifp_terms()
+"""
+def vifp_den(sigma1_sq, sigma_nsq=2, eps=1e-10):
+    sigma1_sq = numpy.maximum(sigma1_sq, 0)
+    sigma1_sq[sigma1_sq<eps] = 0
+    t = sigma1_sq / sigma_nsq
+    t += 1
+    numpy.log10(t, out=t)
+    return numpy.sum(t, dtype=numpy.float64)
+
+"""
+VIF numerator and denominator terms at one scale, from the local moments of that scale
+The denominator depends only on the reference; with compute_den=False it is not computed (returned as None).
+With per_image=True, the moments are of (N, H, W) stacks and the terms are arrays of N sums, one per image.
+All arithmetic is in place in the workspace buffers, in the dtype of the moments; the sums are
+accumulated in float64.
+"""
+def vifp_terms(m, sigma_nsq=2, eps=1e-10, workspace=None, compute_den=True, per_image=False):
+    if workspace is None:
+        workspace = moments.Workspace()
+    shape, dtype = m.sigma1_sq.shape, m.sigma1_sq.dtype
+    buf = lambda name: workspace.buffer(('vifp', name), shape, dtype)
+    mask = lambda name: workspace.buffer(('vifp', name), shape, bool)
+
+    sigma1_sq = numpy.maximum(m.sigma1_sq, 0, out=buf('sigma1_sq'))
+    sigma2_sq = numpy.maximum(m.sigma2_sq, 0, out=buf('sigma2_sq'))
+    sigma12 = m.sigma12
+
+    # g = sigma12 / (sigma1_sq + eps)
+    g = numpy.add(sigma1_sq, eps, out=buf('g'))
+    numpy.divide(sigma12, g, out=g)
+    # sv_sq = sigma2_sq - g * sigma12
+    sv_sq = numpy.multiply(g, sigma12, out=buf('sv_sq'))
+    numpy.subtract(sigma2_sq, sv_sq, out=sv_sq)
+
+    # Where sigma1_sq < eps: g = 0, sv_sq = sigma2_sq, sigma1_sq = 0
+    # Where sigma2_sq < eps: g = 0, sv_sq = 0
+    # Elsewhere where g < 0: g = 0, sv_sq = sigma2_sq
+    low1 = numpy.less(sigma1_sq, eps, out=mask('low1'))
+    low2 = numpy.less(sigma2_sq, eps, out=mask('low2'))
+    reset = numpy.less(g, 0, out=mask('reset'))
+    numpy.logical_or(reset, low1, out=reset)
+    numpy.copyto(sv_sq, sigma2_sq, where=reset)
+    numpy.copyto(sv_sq, 0, where=low2)
+    numpy.logical_or(reset, low2, out=reset)
+    numpy.copyto(g, 0, where=reset)
+    numpy.copyto(sigma1_sq, 0, where=low1)
+    numpy.maximum(sv_sq, eps, out=sv_sq)
+
+    # num = sum(log10(1 + g * g * sigma1_sq / (sv_sq + sigma_nsq)))
+    t = numpy.multiply(g, g, out=buf('t'))
+    numpy.multiply(t, sigma1_sq, out=t)
+    numpy.add(sv_sq, sigma_nsq, out=sv_sq)
+    numpy.divide(t, sv_sq, out=t)
+    numpy.add(t, 1, out=t)
+    numpy.log10(t, out=t)
+    num = _sum(t, per_image)
+
+    if not compute_den:
+        return num, None
+
+    # den = sum(log10(1 + sigma1_sq / sigma_nsq))
+    numpy.divide(sigma1_sq, sigma_nsq, out=t)
+    numpy.add(t, 1, out=t)
+    numpy.log10(t, out=t)
+    den = _sum(t, per_image)
+    return num, den
+
+"""
+Sum in float64 over the whole array, or over the last two axes of each image
+The per-image sums add in the same order as the whole-array sum of a single image.
+"""
+def _sum(t, per_image=False):
+    if not per_image:
+        return numpy.sum(t, dtype=numpy.float64)
+    return numpy.sum(t.reshape(t.shape[:-2] + (-1,)), axis=-1, dtype=numpy.float64)
@@ -0,0 +1,168 @@
+"""
+Video Quality Metrics
+Copyright (c) 2014 Alex Izvorski <aizvorski@gmail.com>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Raw planar YUV file reader
+
+Frames are returned as views into a read-only memory map of the file, so reading a frame does not copy
+or allocate any pixel data; the OS page cache does the buffering.  Callers that need to modify the planes
+or convert them to float will make their own copy anyway (e.g. ref.astype(float)).
+
+Formats are named the same as ffmpeg pixel formats.
+"""
+
+import numpy
+
+"""
+Pixel format: chroma subsampling factors (horizontal, vertical) and sample type
+"""
+class YuvFormat(object):
+    def __init__(self, name, chroma_x, chroma_y, dtype):
+        self.name = name
+        self.chroma_x = chroma_x
+        self.chroma_y = chroma_y
+        self.dtype = numpy.dtype(dtype)
+
+    def plane_shapes(self, width, height):
+        # Odd sizes round up, as in ffmpeg
+        chroma_shape = (-(-height // self.chroma_y), -(-width // self.chroma_x))
+        return ((height, width), chroma_shape, chroma_shape)
+
+    def frame_samples(self, width, height):
+        return sum(h * w for h, w in self.plane_shapes(width, height))
+
+    def frame_bytes(self, width, height):
+        return self.frame_samples(width, height) * self.dtype.itemsize
+
+    @property
+    def max_value(self):
+        return 1023 if self.dtype.itemsize == 2 else 255
+
+FORMATS = dict((f.name, f) for f in [
+    YuvFormat('yuv420p', 2, 2, numpy.uint8),
+    YuvFormat('yuv422p', 2, 1, numpy.uint8),
+    YuvFormat('yuv444p', 1, 1, numpy.uint8),
+    YuvFormat('yuv420p10le', 2, 2, '<u2'),
+    YuvFormat('yuv422p10le', 2, 1, '<u2'),
+    YuvFormat('yuv444p10le', 1, 1, '<u2'),
+])
+
+def get_format(fmt):
+    if isinstance(fmt, YuvFormat):
+        return fmt
+    if fmt not in FORMATS:
+        raise ValueError("Unknown pixel format: %s (supported: %s)" % (fmt, ", ".join(sorted(FORMATS))))
+    return FORMATS[fmt]
+
+"""
+Split one frame's worth of samples into Y, U, V plane views
+"""
+def split_planes(samples, width, height, fmt='yuv420p'):
+    fmt = get_format(fmt)
+    planes = []
+    offset = 0
+    for shape in fmt.plane_shapes(width, height):
+        size = shape[0] * shape[1]
+        planes.append(samples[offset:offset + size].reshape(shape))
+        offset += size
+    return tuple(planes)
+
+"""
+Y, Cb, Cr planes of an RGB image (H, W, 3), BT.601 full range as in JPEG, in the range of the input
+with chroma centered on 128
+"""
+def rgb_to_yuv(img):
+    r, g, b = img[:,:,0], img[:,:,1], img[:,:,2]
+    y = 0.299 * r + 0.587 * g + 0.114 * b
+    u = 128 - 0.168736 * r - 0.331264 * g + 0.5 * b
+    v = 128 + 0.5 * r - 0.418688 * g - 0.081312 * b
+    return y, u, v
+
+"""
+Planes of an image file as float32 in the range of its samples (0-255 for 8-bit images)
+planes: 'y' for [luma], the same as PIL's 'F' conversion (and the removed scipy.misc.imread(flatten=True)),
+or 'yuv' for [Y, Cb, Cr] as rgb_to_yuv.  Grey images have Y equal to the samples and neutral chroma; an alpha
+channel is ignored.
+"""
+def read_image(filename, planes='y'):
+    # Only image inputs need scikit-image
+    import skimage.io
+    img = skimage.io.imread(filename).astype(numpy.float32)
+    if img.ndim == 3 and img.shape[2] < 3:
+        # Grey and alpha
+        img = img[:, :, 0]
+    if img.ndim == 2:
+        if planes == 'y':
+            return [img]
+        return [img, numpy.full_like(img, 128), numpy.full_like(img, 128)]
+    y, u, v = rgb_to_yuv(img[:, :, :3])
+    return [y] if planes == 'y' else [y, u, v]
+
+class YuvReader(object):
+    def __init__(self, filename, width, height, fmt='yuv420p'):
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.format = get_format(fmt)
+        self.frame_samples = self.format.frame_samples(width, height)
+
+        itemsize = self.format.dtype.itemsize
+        file_samples = _file_size(filename) // itemsize
+        # A trailing partial frame is ignored
+        self.num_frames = file_samples // self.frame_samples
+        if self.num_frames > 0:
+            self.data = numpy.memmap(filename, dtype=self.format.dtype, mode='r',
+                                     shape=(self.num_frames, self.frame_samples))
+        else:
+            self.data = numpy.zeros((0, self.frame_samples), dtype=self.format.dtype)
+
+    def __len__(self):
+        return self.num_frames
+
+    """
+    Random access to frame n, returns (y, u, v) views into the memory map
+    """
+    def frame(self, n):
+        if n < 0 or n >= self.num_frames:
+            raise IndexError("Frame %d out of range, %s has %d frames" % (n, self.filename, self.num_frames))
+        return split_planes(self.data[n], self.width, self.height, self.format)
+
+    def __getitem__(self, n):
+        return self.frame(n)
+
+    def frame_indices(self, start=0, count=None, step=1):
+        stop = self.num_frames
+        if count is not None:
+            stop = min(stop, start + count * step)
+        return range(start, stop, step)
+
+    """
+    Iterate over (frame number, (y, u, v)), stopping cleanly at the end of the file
+    """
+    def frames(self, start=0, count=None, step=1):
+        for n in self.frame_indices(start, count, step):
+            yield n, self.frame(n)
+
+    def __iter__(self):
+        for _, planes in self.frames():
+            yield planes
+
+def _file_size(filename):
+    with open(filename, 'rb') as fh:
+        fh.seek(0, 2)
+        return fh.tell()